@@ -1,12 +1,28 @@
-from flask import Flask, request, jsonify
-import subprocess
+from flask import Flask, request, jsonify, send_file
 import gdown
 import os
+import sys
 from flask_cors import CORS
+from jobs import JobQueue, QueueFullError
+from workspace import WorkspaceManager, DiskQuotaError, publish_file
 
 app = Flask(__name__)
 CORS(app)
 
+# The inference code resolves checkpoints/ and temp/ relative to video-retalking,
+# so move there once and load every model a single time per worker.
+ENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'video-retalking')
+os.chdir(ENGINE_DIR)
+sys.path.insert(0, ENGINE_DIR)
+from inference import LipSyncEngine
+from utils.inference_utils import default_options
+# the preprocessing cache can live on a volume shared by every worker
+engine = LipSyncEngine(default_options(
+    cache_dir=os.environ.get('LIPSYNC_CACHE_DIR', 'temp/preprocess_cache'),
+    cache_max_gb=float(os.environ.get('LIPSYNC_CACHE_MAX_GB', 20)),
+    cache_policy=os.environ.get('LIPSYNC_CACHE_POLICY', 'lru'),
+))
+
 
 output_path = '/tmp/uploaded_data/outputs/output_lip_sync.mp4'
 
@@ -20,6 +36,54 @@ def download_from_google_drive(url, output_path):
     except Exception as e:
         print(f"Failed to download file from {url}. Error: {str(e)}")
 
+# Bounded pool of render workers shared by /lip_sync and /jobs
+jobs = JobQueue(
+    engine,
+    # one workspace per job, so concurrent jobs never share a file
+    workspaces=WorkspaceManager(
+        '/tmp/uploaded_data/jobs',
+        quota_bytes=int(os.environ.get('LIPSYNC_DISK_QUOTA_MB', 20480)) * 2 ** 20,
+        ttl=int(os.environ.get('LIPSYNC_RESULT_TTL', 3600)),
+    ),
+    download=download_from_google_drive,
+    max_workers=int(os.environ.get('LIPSYNC_WORKERS', 1)),
+    max_pending=int(os.environ.get('LIPSYNC_MAX_PENDING', 16)),
+)
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.json
+    if not data or not data.get('face_url') or not data.get('audio_url'):
+        return jsonify({'error': 'Both face_url and audio_url are required'}), 400
+    try:
+        job = jobs.submit(data['face_url'], data['audio_url'], {'pads': data.get('pads', [0, 10, 0, 0])})
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    except DiskQuotaError as e:
+        return jsonify({'error': str(e)}), 507
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+    if job.status != 'done':
+        return jsonify({'error': f'Job is {job.status}'}), 409
+    if not os.path.isfile(job.output_path):
+        return jsonify({'error': 'The result has expired'}), 410
+    return send_file(job.output_path, mimetype='video/mp4', as_attachment=True, download_name='output_lip_sync.mp4')
+
 
 @app.route('/lip_sync', methods=['POST'])
 def lip_sync():
@@ -31,38 +95,43 @@ def lip_sync():
         pads = data.get('pads', [0, 10, 0, 0])
         output_path = '/tmp/uploaded_data/outputs/output_lip_sync.mp4'  # Default output path
 
-        face_path = '/tmp/uploaded_data/video/face_video.mp4'
-        audio_path = '/tmp/uploaded_data/audio/audio.wav'
-
         # Ensure directories exist
-        os.makedirs(os.path.dirname(face_path), exist_ok=True)
-        os.makedirs(os.path.dirname(audio_path), exist_ok=True)
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-        # Download the files from Google Drive with progress bar
-        print("Downloading target video...")
-        download_from_google_drive(face_url, face_path)
-        print("Downloading source image...")
-        download_from_google_drive(audio_url, audio_path)
-
-        if not face_path or not audio_path:
+        if not face_url or not audio_url:
             return jsonify({'error': 'Face and audio file paths are required'}), 400
-        
-        # Change the working directory to Video_retalking
-        os.chdir('Video_retalking')
-        # Construct the command
-        command = [
-            'python3', 'inference.py',
-            '--face', face_path,
-            '--audio', audio_path,
-            '--pads'] + list(map(str, pads)) + ['--outfile', output_path]
-        
-        # Execute the command
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        return jsonify({'message': 'Processing completed successfully', 'output': output_path, 'logs': result.stdout}), 200
+
+        # Same queue as /jobs; this route simply waits for the job to finish
+        job = jobs.submit(face_url, audio_url, {'pads': pads})
+        job.future.result()
+        if job.status == 'failed':
+            return jsonify({'error': f'Error during processing: {job.error}', 'job_id': job.id}), 500
+        # the job renders in its own workspace, the legacy path only gets a copy of the finished video
+        publish_file(job.output_path, output_path)
+        return jsonify({'message': 'Processing completed successfully', 'output': output_path, 'job_id': job.id,
+                        'timings': job.timings}), 200
     
-    except subprocess.CalledProcessError as e:
-        return jsonify({'error': f'Error during processing: {e}', 'logs': e.stderr}), 500
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    except DiskQuotaError as e:
+        return jsonify({'error': str(e)}), 507
+    except Exception as e:
+        return jsonify({'error': f'Error during processing: {e}'}), 500
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    # hit/miss/eviction counters of this worker and the size of the shared preprocessing cache
+    return jsonify(engine.cache.stats())
+
+# per-stage timings of the finished jobs, when prometheus_client is installed
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+except ImportError:
+    pass
 
 @app.route('/get_path_lip_sync', methods=['GET'])
 def get_path_face_swap():
@@ -1,13 +1,15 @@
 from fastapi import FastAPI, HTTPException, Depends, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-import subprocess
+import asyncio
 import gdown
 import os
-from tqdm import tqdm  
+import sys
 import uvicorn
 from pydantic import BaseModel
 from model_setup import setup_environment
+from jobs import JobQueue, QueueFullError
+from workspace import WorkspaceManager, DiskQuotaError, publish_file
 from pathlib import Path
 from typing import Optional
 
@@ -24,6 +26,17 @@ app.add_middleware(
 
 setup_environment()
 
+# setup_environment() leaves us inside video-retalking; load every model once per worker.
+sys.path.insert(0, os.getcwd())
+from inference import LipSyncEngine
+from utils.inference_utils import default_options
+# the preprocessing cache can live on a volume shared by every worker
+engine = LipSyncEngine(default_options(
+    cache_dir=os.environ.get('LIPSYNC_CACHE_DIR', 'temp/preprocess_cache'),
+    cache_max_gb=float(os.environ.get('LIPSYNC_CACHE_MAX_GB', 20)),
+    cache_policy=os.environ.get('LIPSYNC_CACHE_POLICY', 'lru'),
+))
+
 output_path = Path('/lip_sync/outputs/output_lip_sync.mp4')
 
 # Pydantic BaseModel for request data validation 
@@ -41,6 +54,20 @@ def download_from_google_drive(url, output_path):
         print(f"File downloaded successfully to {output_path}")
     except Exception as e:
         print(f"Failed to download file from {url}. Error: {str(e)}")
+
+# Bounded pool of render workers; requests only enqueue work so the event loop stays free
+jobs = JobQueue(
+    engine,
+    # one workspace per job, so concurrent jobs never share a file
+    workspaces=WorkspaceManager(
+        '/lip_sync/jobs',
+        quota_bytes=int(os.environ.get('LIPSYNC_DISK_QUOTA_MB', 20480)) * 2 ** 20,
+        ttl=int(os.environ.get('LIPSYNC_RESULT_TTL', 3600)),
+    ),
+    download=download_from_google_drive,
+    max_workers=int(os.environ.get('LIPSYNC_WORKERS', 1)),
+    max_pending=int(os.environ.get('LIPSYNC_MAX_PENDING', 16)),
+)
         
 async def form_or_json(
     face_url: Optional[str] = Form(None),
@@ -57,58 +84,84 @@ async def form_or_json(
     if not face_url or not audio_url:
         raise HTTPException(status_code=400, detail="Both face_url and audio_url are required.")
     
-    return {"face_url": face_url, "audio_url": audio_url}
+    return LipSyncRequest(face_url=face_url, audio_url=audio_url, pads=request.pads)
+
+def submit_job(data, options):
+    try:
+        return jobs.submit(data.face_url, data.audio_url, options)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except DiskQuotaError as e:
+        raise HTTPException(status_code=507, detail=str(e))
+
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail='Unknown job id')
+    return job
+
+@app.post('/jobs', status_code=202)
+async def create_job(data: LipSyncRequest = Depends(form_or_json)):
+    """
+    Queue a lip sync job and return its id right away.
+    """
+    job = submit_job(data, {'pads': data.pads})
+    return job.to_dict()
+
+@app.get('/jobs/{job_id}')
+async def job_status(job_id: str):
+    """
+    Status, stage and progress (0-100) of a job.
+    """
+    return get_job(job_id).to_dict()
+
+@app.get('/jobs/{job_id}/result')
+async def job_result(job_id: str):
+    """
+    Download the video rendered by a finished job.
+    """
+    job = get_job(job_id)
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f'Job is {job.status}')
+    if not os.path.isfile(job.output_path):
+        raise HTTPException(status_code=410, detail='The result has expired')
+    return FileResponse(job.output_path, media_type='video/mp4', filename='output_lip_sync.mp4')
 
 @app.post('/lip_sync')
 async def lip_sync(data: LipSyncRequest = Depends(form_or_json)):
     try:
-        face_url = data.face_url
-        audio_url = data.audio_url
-        pads = data.pads
-        output_path = '/lip_sync/outputs/output_lip_sync.mp4'  # Default output path
+        output_path = Path('/lip_sync/outputs/output_lip_sync.mp4')  # Default output path
+        output_path.parent.mkdir(parents=True, exist_ok=True)
 
-        face_path = Path('/lip_sync/data_from_user/videos/face_video.mp4')
-        audio_path = Path('/lip_sync/data_from_user/audios/audio.wav')
+        # Same queue as /jobs, but wait (without blocking the event loop) for the result
+        job = submit_job(data, {'pads': data.pads})
+        await asyncio.wrap_future(job.future)
 
-        # Ensure directories exist
-        face_path.parent.mkdir(parents=True, exist_ok=True)
-        audio_path.parent.mkdir(parents=True, exist_ok=True)
-        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if job.status == 'failed':
+            return JSONResponse(content={'error': f'Error during processing: {job.error}', 'job_id': job.id}, status_code=500)
+        # the job renders in its own workspace, the legacy path only gets a copy of the finished video
+        await asyncio.get_running_loop().run_in_executor(None, publish_file, job.output_path, str(output_path))
+        return JSONResponse(content={'message': 'Processing completed successfully', 'output': str(output_path), 'job_id': job.id,
+                                     'timings': job.timings}, status_code=200)
 
-        # Download the files from Google Drive with progress bar
-        print("Downloading target video...")
-        download_from_google_drive(face_url, face_path)
-        print("Downloading source audio...")
-        download_from_google_drive(audio_url, audio_path)
-
-        if not os.path.exists(face_path) or not os.path.exists(audio_path):
-            raise HTTPException(status_code=400, detail='Face and audio file paths are required')
-
-        # Change the working directory to Video_retalking
-        os.chdir('Video_retalking')
-        # Construct the command
-        command = [
-            'python3', 'inference.py',
-            '--face', face_path,
-            '--audio', audio_path,
-            '--pads'] + list(map(str, pads)) + ['--outfile', output_path]
-        
-         # Execute the command with tqdm progress bar
-        with tqdm(total=100, desc="Lip Sync", unit="%") as pbar:
-            result = subprocess.run(command, check=True, capture_output=True, text=True)
-            pbar.update(100)  # Assuming 100% progress after subprocess finishes
-
-        # If the command was successful, return the output path
-        if result.returncode == 0:
-            return JSONResponse(content={'message': 'Processing completed successfully', 'output': str(output_path), 'logs': result.stdout}, status_code=200)
-
-    except subprocess.CalledProcessError as e:
-        # Handle errors during command execution
-        return JSONResponse(content={'error': f'Error during processing: {str(e)}', 'logs': e.stderr}, status_code=500)
+    except HTTPException:
+        raise
     except Exception as e:
         # Handle any other unexpected errors
         return JSONResponse(content={'error': f'An error occurred: {str(e)}'}, status_code=500)
 
+@app.get('/cache/stats')
+async def cache_stats():
+    # hit/miss/eviction counters of this worker and the size of the shared preprocessing cache
+    return engine.cache.stats()
+
+# per-stage timings of the finished jobs, when prometheus_client is installed
+try:
+    from prometheus_client import make_asgi_app
+    app.mount('/metrics', make_asgi_app())
+except ImportError:
+    pass
+
 @app.get('/get_path_lip_sync')
 async def get_path_face_swap():
     try:
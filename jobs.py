@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue already holds ``max_pending`` jobs."""
+
+
+class Job:
+    """State of one lip sync request, as reported by ``GET /jobs/{id}``."""
+
+    def __init__(self, job_id, face_url, audio_url, options):
+        self.id = job_id
+        self.face_url = face_url
+        self.audio_url = audio_url
+        self.options = options
+        self.status = 'queued'  # queued -> running -> done | failed
+        self.stage = None
+        self.progress = 0.
+        self.error = None
+        self.output_path = None
+        self.timings = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': round(self.progress, 1),
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'timings': self.timings,
+        }
+
+
+class JobQueue:
+    """Runs lip sync jobs on a bounded pool of worker threads, off the web server's request handlers.
+
+    Args:
+        engine (LipSyncEngine): the engine shared by every worker.
+        workspaces (WorkspaceManager): every job downloads its inputs, keeps its intermediate files and
+            writes its result in a workspace of its own.
+        download (callable): ``download(url, path)`` fetching a user file.
+        max_workers (int): number of jobs rendered at the same time.
+        max_pending (int): number of queued or running jobs accepted before ``submit`` raises ``QueueFullError``.
+
+    A finished job is forgotten once its result has expired from the workspaces, ``workspaces.ttl`` seconds
+    after it finished.
+    """
+
+    def __init__(self, engine, workspaces, download, max_workers=1, max_pending=16):
+        self.engine = engine
+        self.workspaces = workspaces
+        self.download = download
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='lipsync')
+        self.jobs = {}
+        self.pending = 0  # queued or running jobs
+        self.finished = deque()  # finished jobs, oldest first
+        self.lock = threading.Lock()
+
+    def submit(self, face_url, audio_url, options=None):
+        with self.lock:
+            self._evict_expired()
+            if self.pending >= self.max_pending:
+                raise QueueFullError('{} jobs are already waiting, try again later'.format(self.pending))
+            self.workspaces.check_quota()
+            job = Job(uuid.uuid4().hex, face_url, audio_url, dict(options or {}))
+            self.jobs[job.id] = job
+            self.pending += 1
+        job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            self._evict_expired()
+            return self.jobs.get(job_id)
+
+    def _evict_expired(self):
+        # the results of these jobs are purged from the workspaces by now (called with the lock held)
+        deadline = time.time() - self.workspaces.ttl
+        while self.finished and self.finished[0].finished_at < deadline:
+            self.jobs.pop(self.finished.popleft().id, None)
+
+    def _run(self, job):
+        stages = self.engine.stages
+
+        def progress(stage, done):
+            job.stage = stage
+            job.progress = 100. * (stages.index(stage) + done) / len(stages)
+
+        job.status, job.stage, job.started_at = 'running', 'download', time.time()
+        workspace, keep = None, ()
+        try:
+            workspace = self.workspaces.create(job.id)
+            face_path = workspace.path('face_video.mp4')
+            audio_path = workspace.path('audio.wav')
+            self.download(job.face_url, face_path)
+            self.download(job.audio_url, audio_path)
+            if not os.path.isfile(face_path) or not os.path.isfile(audio_path):
+                raise ValueError('Could not download the face video or the audio')
+            self.workspaces.check_quota()
+
+            # every file of the job stays in its workspace, whatever the options say
+            options = dict(job.options)
+            options['outfile'] = workspace.path('output_lip_sync.mp4')
+            options['work_dir'] = workspace.temp_dir
+            options['timing_report'] = workspace.path('timings.json')
+            job.output_path = self.engine.run(face_path, audio_path, options, progress=progress)
+            job.status, job.progress = 'done', 100.
+            keep = (job.output_path,)
+        except Exception as e:
+            traceback.print_exc()
+            job.status, job.error = 'failed', str(e)
+        finally:
+            if workspace is not None:
+                job.timings = self._read_timings(workspace.path('timings.json'))
+                self.workspaces.release(workspace, keep)
+            with self.lock:
+                job.finished_at = time.time()
+                self.finished.append(job)
+                self.pending -= 1
+        return job
+
+    @staticmethod
+    def _read_timings(path):
+        """The per-stage timing report written by the engine, if it got that far."""
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,120 @@
+"""Numerical equivalence and speed of the CPU ``upfirdn2d`` and ``fused_leaky_relu`` of GPEN against their reference.
+
+``upfirdn2d_conv`` (the depthwise convolutions the CPU runs) is checked against ``upfirdn2d_native`` for
+several up/down factors, paddings (negative ones crop) and kernels, ``fused_leaky_relu_native`` against
+``scale * leaky_relu(input + bias)``, with and without autograd. Then both ops are timed on the shapes of
+one forward pass of GPEN-BFR-512, one call per resolution: the blur of the upsampling convolutions, the
+blur of the downsampling ones, the upsampling of the RGB skips and the activations.
+
+    python benchmarks/bench_gpen_ops.py
+    python benchmarks/bench_gpen_ops.py --batch 8 --threads 4
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'third_part', 'GPEN'))
+from face_model.op.fused_act import fused_leaky_relu_native
+from face_model.op.upfirdn2d import upfirdn2d_conv, upfirdn2d_native
+
+# channels of GPEN-BFR-512 (channel_multiplier=2, narrow=1) by resolution
+CHANNELS = {8: 512, 16: 512, 32: 512, 64: 512, 128: 256, 256: 128, 512: 64}
+
+
+def blur_kernel(k=(1, 3, 3, 1)):
+    k = torch.tensor(k, dtype=torch.float32)
+    k = k[None, :] * k[:, None]
+    return k / k.sum()
+
+
+def check_upfirdn2d(atol):
+    asymmetric = torch.rand(3, 5)
+    cases = [(blur_kernel() * 4, (2, 2), (1, 1), (2, 1, 2, 1)),    # Upsample
+             (blur_kernel() * 4, (1, 1), (1, 1), (1, 1, 1, 1)),    # Blur after an upsampling conv
+             (blur_kernel(), (1, 1), (2, 2), (1, 1, 1, 1)),        # Downsample
+             (blur_kernel(), (1, 1), (1, 1), (2, 2, 2, 2)),        # Blur before a downsampling conv
+             (asymmetric, (2, 3), (1, 1), (0, 3, -1, 2)),
+             (asymmetric, (1, 1), (3, 2), (4, 0, 1, -1)),
+             (asymmetric, (3, 2), (2, 3), (2, 2, -2, 3))]
+    for kernel, (up_x, up_y), (down_x, down_y), (pad_x0, pad_x1, pad_y0, pad_y1) in cases:
+        x = torch.randn(2, 5, 13, 17)
+        reference = upfirdn2d_native(x, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1)
+        out = upfirdn2d_conv(x, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1)
+        assert out.shape == reference.shape, 'upfirdn2d {} instead of {}'.format(tuple(out.shape), tuple(reference.shape))
+        diff = (out - reference).abs().max().item()
+        assert diff < atol, 'upfirdn2d up {} down {} pad {} differs by {:.2e}'.format(
+            (up_x, up_y), (down_x, down_y), (pad_x0, pad_x1, pad_y0, pad_y1), diff)
+
+        # the gradients too, GPEN is trained with these ops
+        x.requires_grad_(True)
+        grad, = torch.autograd.grad(upfirdn2d_native(x, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1).sum(), x)
+        grad_conv, = torch.autograd.grad(upfirdn2d_conv(x, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1).sum(), x)
+        assert (grad - grad_conv).abs().max().item() < atol, 'the gradients of upfirdn2d differ'
+    print('upfirdn2d_conv: {} cases match upfirdn2d_native within {}'.format(len(cases), atol))
+
+
+def check_fused_leaky_relu():
+    for shape in ((4, 512), (2, 64, 32, 32)):
+        x, bias = torch.randn(shape), torch.randn(shape[1])
+        reference = 2 ** 0.5 * F.leaky_relu(x + bias.view((1, -1) + (1,) * (len(shape) - 2)), negative_slope=0.2)
+        with torch.no_grad():
+            assert torch.equal(fused_leaky_relu_native(x, bias), reference), 'fused_leaky_relu differs'
+        bias.requires_grad_(True)
+        assert torch.equal(fused_leaky_relu_native(x, bias), reference), 'fused_leaky_relu differs with autograd'
+        assert fused_leaky_relu_native(x, bias).requires_grad, 'fused_leaky_relu lost the gradient'
+    print('fused_leaky_relu_native: same as scale * leaky_relu(input + bias)')
+
+
+def timeit(fn, repeat):
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    check_upfirdn2d(args.atol)
+    check_fused_leaky_relu()
+
+    up, down = blur_kernel() * 4, blur_kernel()
+    ops = [('blur after upsampling conv', lambda c, s: (c, s + 1), (up, 1, 1, 1, 1, 1, 1, 1, 1)),
+           ('blur before downsampling conv', lambda c, s: (c, s), (down, 1, 1, 1, 1, 2, 2, 2, 2)),
+           ('upsample of the RGB skip', lambda c, s: (3, s // 2), (up, 2, 2, 1, 1, 2, 1, 2, 1))]
+    torch.set_grad_enabled(False)
+    for name, shape, params in ops:
+        native_seconds = conv_seconds = 0
+        for size, channel in CHANNELS.items():
+            c, s = shape(channel, size)
+            x = torch.randn(args.batch, c, s, s)
+            native_seconds += timeit(lambda: upfirdn2d_native(x, *params), args.repeat)
+            conv_seconds += timeit(lambda: upfirdn2d_conv(x, *params), args.repeat)
+        print('{:30s} native {:8.1f} ms, conv {:7.1f} ms ({:.1f}x)'.format(
+            name, native_seconds * 1000, conv_seconds * 1000, native_seconds / conv_seconds))
+
+    reference_seconds = fused_seconds = 0
+    for size, channel in CHANNELS.items():
+        x, bias = torch.randn(args.batch, channel, size, size), torch.randn(channel)
+        reference_seconds += timeit(lambda: 2 ** 0.5 * F.leaky_relu(x + bias.view(1, -1, 1, 1), negative_slope=0.2), args.repeat)
+        fused_seconds += timeit(lambda: fused_leaky_relu_native(x, bias), args.repeat)
+    print('{:30s} out of place {:4.1f} ms, in place {:4.1f} ms ({:.1f}x)'.format(
+        'fused_leaky_relu', reference_seconds * 1000, fused_seconds * 1000, reference_seconds / fused_seconds))
+
+
+if __name__ == '__main__':
+    main()
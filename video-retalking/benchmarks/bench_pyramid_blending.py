@@ -0,0 +1,70 @@
+"""Speed of the torch Laplacian pyramid blending of a batch against ``Laplacian_Pyramid_Blending_with_mask`` frame by frame.
+
+Blends batches of 512x512 frames like Step 6 (10 levels, capped at 4 pixels) and the compositing of
+``FaceEnhancement`` (6 levels), and checks that the results are the same as OpenCV's up to float rounding
+(and the level cap). ``laplacian_pyramid_blending_batch`` only uses torch on a GPU: on a CPU, OpenCV's
+pyramids are faster.
+
+    python benchmarks/bench_pyramid_blending.py --batch 16
+    python benchmarks/bench_pyramid_blending.py --batch 16 --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.inference_utils import Laplacian_Pyramid_Blending_with_mask, laplacian_pyramid_blending_tensor, pyramid_levels
+
+
+def frames(batch, size, seed=0):
+    """Textured images and the soft mouth-like masks blending them."""
+    rng = np.random.RandomState(seed)
+    A = np.stack([cv2.GaussianBlur((rng.rand(size, size, 3) * 255).astype(np.uint8), (5, 5), 1) for _ in range(batch)])
+    B = np.stack([cv2.GaussianBlur((rng.rand(size, size, 3) * 255).astype(np.uint8), (5, 5), 1) for _ in range(batch)])
+    m = np.zeros((batch, size, size), np.float32)
+    for mask in m:
+        center = (size // 2 + rng.randint(-20, 20), int(size * 0.7) + rng.randint(-20, 20))
+        cv2.ellipse(mask, center, (size // 6, size // 12), 0, 0, 360, 1., -1)
+    return A, B, np.stack([cv2.GaussianBlur(mask, (0, 0), 4) for mask in m])
+
+
+def timeit(fn, repeat, device):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    A, B, m = frames(args.batch, args.size)
+    for num_levels, min_size, atol in ((10, 1, 1e-3), (10, 4, 0.5), (6, 1, 1e-3)):
+        reference, opencv_seconds = timeit(lambda: np.stack([Laplacian_Pyramid_Blending_with_mask(a, b, mask, num_levels)
+                                                             for a, b, mask in zip(A, B, m)]), args.repeat, 'cpu')
+        levels = pyramid_levels((args.size, args.size), num_levels, min_size)
+        blended, torch_seconds = timeit(lambda: laplacian_pyramid_blending_tensor(A, B, m, levels, args.device),
+                                        args.repeat, args.device)
+        diff = np.abs(reference - blended).max()
+        print('{:2d} levels, min size {}: opencv {:7.2f} ms/frame, torch {:7.2f} ms/frame ({:.1f}x), max abs diff {:.2e}'.format(
+            num_levels, min_size, opencv_seconds * 1000 / args.batch, torch_seconds * 1000 / args.batch,
+            opencv_seconds / torch_seconds, diff))
+        assert diff < atol, 'the blends differ by more than {}'.format(atol)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Numerical equivalence and speed of the torch mel frontend against the librosa one (``hp.mel_frontend``).
+
+Both frontends compute the normalized mel spectrogram of the same audio, a wav file or a synthetic
+voice-like signal, and must agree within ``--atol`` on the [-4, 4] scale of the normalized mels.
+
+    python benchmarks/check_mel_frontend.py --seconds 120
+    python benchmarks/check_mel_frontend.py --wav examples/audio/1.wav
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import audio
+from utils.hparams import hparams as hp
+
+
+def synthetic_voice(seconds, sr, seed=0):
+    """Harmonics of a gliding pitch with a syllable-like envelope, noise and silences."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    pitch = 120 + 40 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sr
+    wav = sum(np.sin(k * phase) / k for k in range(1, 20))
+    envelope = np.clip(np.sin(2 * np.pi * 3 * t), 0, None) * (rng.rand(len(t) // sr + 1)[(t).astype(int)] > 0.2)
+    wav = wav * envelope + 0.01 * rng.randn(len(t))
+    return (0.5 * wav / np.abs(wav).max()).astype(np.float32)
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--wav', type=str, default=None, help='audio to compare on, a synthetic voice by default')
+    parser.add_argument('--seconds', type=float, default=60, help='length of the synthetic voice')
+    parser.add_argument('--atol', type=float, default=1e-3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    wav = audio.load_wav(args.wav, hp.sample_rate) if args.wav else synthetic_voice(args.seconds, hp.sample_rate)
+    basis_diff = np.abs(audio._numpy_mel_basis() - audio._build_mel_basis()).max()
+    print('mel basis: max abs diff {:.2e}'.format(basis_diff))
+
+    mel_librosa, librosa_seconds = timeit(lambda: audio.melspectrogram(wav, frontend='librosa'), args.repeat)
+    mel_torch, torch_seconds = timeit(lambda: audio.melspectrogram(wav, frontend='torch'), args.repeat)
+    diff = np.abs(mel_librosa - mel_torch)
+    print('{:.1f}s of audio, {} mel frames'.format(len(wav) / hp.sample_rate, mel_librosa.shape[1]))
+    print('librosa: {:8.1f} ms'.format(librosa_seconds * 1000))
+    print('  torch: {:8.1f} ms ({:.1f}x)'.format(torch_seconds * 1000, librosa_seconds / torch_seconds))
+    print('max abs diff {:.2e}, mean abs diff {:.2e}'.format(diff.max(), diff.mean()))
+
+    assert mel_librosa.shape == mel_torch.shape, 'the frontends give {} and {} frames'.format(mel_librosa.shape, mel_torch.shape)
+    assert basis_diff < 1e-6, 'the mel filters differ'
+    assert diff.max() < args.atol, 'the frontends differ by more than {}'.format(args.atol)
+    print('equivalent')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import numpy as np
-import cv2, os, sys, subprocess, platform, torch
+import cv2, os, sys, copy, threading, torch
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from scipy.io import loadmat
 
@@ -17,114 +18,269 @@ from third_part.GPEN.gpen_face_enhancer import FaceEnhancement
 from third_part.GFPGAN.gfpgan import GFPGANer
 # expression control
 from third_part.ganimation_replicate.model.ganimation import GANimationModel
+from third_part import face_detection
 
 from utils import audio
 from utils.ffhq_preprocess import Croper
+from utils.preprocess_cache import PreprocessCache, file_hash
+from utils.frame_reader import FrameReader
+from utils.video_writer import FFmpegWriter
+from utils.pipeline import OrderedPool, prefetch
+from utils.profiler import StageProfiler
+from utils.face_tracking import tracker_from_options
 from utils.alignment_stit import crop_faces, calc_alignment_coefficients, paste_image
-from utils.inference_utils import Laplacian_Pyramid_Blending_with_mask, face_detect, load_model, options, split_coeff, \
-                                  trans_image, transform_semantic, find_crop_norm_ratio, load_face3d_net, exp_aus_dict
+from utils.inference_utils import laplacian_pyramid_blending_batch, feather_region, composite_face, face_detect, load_model, options, split_coeff, \
+                                  trans_image, transform_semantic_batch, find_crop_norm_ratio, self_crop_norm_ratios, load_face3d_net, exp_aus_dict, \
+                                  default_options, detect_face_rects, face_boxes, \
+                                  landmarks_to_5pts, crop_to_frame, frame_to_crop
 import warnings
 warnings.filterwarnings("ignore")
 
-args = options()
-
-def main():    
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    print('[Info] Using {} for inference.'.format(device))
-    os.makedirs(os.path.join('temp', args.tmp_dir), exist_ok=True)
-
-    enhancer = FaceEnhancement(base_dir='checkpoints', size=512, model='GPEN-BFR-512', use_sr=False, \
-                               sr_model='rrdb_realesrnet_psnr', channel_multiplier=2, narrow=1, device=device)
-    restorer = GFPGANer(model_path='checkpoints/GFPGANv1.3.pth', upscale=1, arch='clean', \
-                        channel_multiplier=2, bg_upsampler=None)
-
-    base_name = args.face.split('/')[-1]
-    if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-        args.static = True
+# stages reported to the progress callback of LipSyncEngine.run, in order
+STAGES = ['frames', 'landmarks', '3dmm', 'stabilize', 'audio', 'enhance', 'lip_sync']
+
+
+class LipSyncEngine(object):
+    """Keeps every model of the pipeline in memory so that repeated calls to
+    ``run`` only pay for the compute of the request itself.
+
+    Args:
+        args (Namespace): defaults for every request; the model paths are read once here.
+    """
+    stages = STAGES
+
+    def __init__(self, args=None):
+        self.args = args if args is not None else default_options()
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        print('[Info] Using {} for inference.'.format(self.device))
+
+        self.enhancer = FaceEnhancement(base_dir='checkpoints', size=512, model='GPEN-BFR-512', use_sr=False, \
+                                        sr_model='rrdb_realesrnet_psnr', channel_multiplier=2, narrow=1, device=self.device)
+        self.restorer = GFPGANer(model_path='checkpoints/GFPGANv1.3.pth', upscale=1, arch='clean', \
+                                 channel_multiplier=2, bg_upsampler=None)
+        self.croper = Croper('checkpoints/shape_predictor_68_face_landmarks.dat')
+        self.kp_extractor = KeypointExtractor()
+        self.face_detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, \
+                                                          device='cuda:0' if self.device == 'cuda' else 'cpu')
+        self.net_recon = load_face3d_net(self.args.face3d_net_path, self.device)
+        self.lm3d_std = load_lm3d('checkpoints/BFM')
+        self.expressions = loadmat('checkpoints/expression.mat')
+        # load DNet, model(LNet and ENet)
+        self.D_Net, self.model = load_model(self.args, self.device)
+        self.ganimation = None
+        self.cache = PreprocessCache(self.args.cache_dir or None, max_bytes=int(self.args.cache_max_gb * 2 ** 30),
+                                     policy=self.args.cache_policy)
+        # GFPGANer keeps the faces of the current image on its face helper, so only one job may use it at a time
+        self.restorer_lock = threading.Lock()
+
+    def get_ganimation(self):
+        if self.ganimation is None:
+            self.ganimation = GANimationModel()
+            self.ganimation.initialize()
+            self.ganimation.setup()
+        return self.ganimation
+
+    def make_args(self, face, audio, options=None):
+        args = copy.deepcopy(self.args)
+        args.face, args.audio = face, audio
+        for key, value in (options or {}).items():
+            setattr(args, key, value)
+        return args
+
+    def run(self, face, audio, options=None, progress=None):
+        """Lip-sync ``face`` (video or image) to ``audio`` and return the path of the result.
+
+        ``options`` is a dict overriding the defaults given at construction, e.g. ``{'pads': [0, 10, 0, 0]}``.
+        ``progress`` is called as ``progress(stage, done)`` with a stage of ``STAGES`` and ``done`` in [0, 1].
+        """
+        args = self.make_args(face, audio, options)
+        report = progress if progress is not None else lambda stage, done: None
+        device, cache, refresh = self.device, self.cache, args.re_preprocess
+        os.makedirs(os.path.join(args.work_dir, args.tmp_dir), exist_ok=True)
+        profiler = StageProfiler()
+
+        def stage(name):
+            report(name, 0.)
+            return profiler.stage(name)
+
+        try:
+            with stage('frames'):
+                # the full size frames are decoded again by every stage that needs them, never held all at once
+                frames = read_frames(args)
+                fps = frames.fps
+                # every result of Steps 0-3 and 5 only depends on the video and on these options, whatever the file name
+                video_key = cache.key(cache.file_key(args.face), tuple(args.crop))
+                if args.track_faces:
+                    video_key = cache.key(video_key, args.keyframe_interval, args.track_motion_threshold)
+                exp_img = args.exp_img
+                if exp_img is not None and os.path.isfile(exp_img):
+                    exp_img = file_hash(exp_img)
+                stable_key = cache.key(video_key, exp_img, bool(args.one_shot))
+
+                crop_quad = cache.get_or_compute(video_key, 'crop', lambda: find_crop(frames, self.croper), refresh)
+                frames_pil, cox = crop_frames(frames, *crop_quad)
+                print ("[Step 0] Number of frames available for inference: "+str(len(frames_pil)))
+            profiler.add_frames('frames', len(frames_pil))
+
+            with stage('landmarks'):
+                # the face detector runs once per frame, every later stage reuses its boxes or the landmarks found in them
+                face_rects = cache.get_or_extend(video_key, 'face_rects', len(frames_pil), lambda start, stop: \
+                    detect_frame_rects(frames, start, stop, args, self.face_detector, profiler=profiler), refresh)
+                crop_rects = frame_to_crop(face_rects, cox)
+                lm = cache.get_or_compute(video_key, 'landmarks',
+                    lambda: extract_landmarks(frames_pil, self.kp_extractor, crop_rects, tracker_from_options(args)), refresh)
+            profiler.add_frames('landmarks', len(frames_pil))
+            with stage('3dmm'):
+                semantic_npy = cache.get_or_compute(video_key, 'coeffs',
+                    lambda: extract_coeffs(frames_pil, lm, self.net_recon, self.lm3d_std, device, args.face3d_batch_size), refresh).astype(np.float32)
+            profiler.add_frames('3dmm', len(frames_pil))
+            with stage('stabilize'):
+                imgs = cache.get_or_compute(stable_key, 'stabilized', lambda: stabilize_expression(
+                    frames_pil, semantic_npy, load_expression(args, self.expressions, self.kp_extractor, self.net_recon,
+                                                              self.lm3d_std, device), self.D_Net, args, device), refresh)
+                torch.cuda.empty_cache()
+            profiler.add_frames('stabilize', len(frames_pil))
+
+            with stage('audio'):
+                mel_chunks = load_mel_chunks(args, fps, cache, refresh)
+                print("[Step 4] Load audio; Length of mel chunks: {}".format(len(mel_chunks)))
+            imgs = imgs[:len(mel_chunks)]
+            lm5 = [None if np.mean(points) == -1 else landmarks_to_5pts(points) for points in lm[:len(imgs)]]
+
+            # the audio decides how many frames are used, a longer clip extends the cached prefix
+            with stage('enhance'):
+                imgs_enhanced = cache.get_or_extend(stable_key, 'enhanced', len(imgs), lambda start, stop: \
+                    enhance_references(imgs[start:stop], self.enhancer, crop_rects[start:stop], lm5[start:stop],
+                                       args.GPEN_batch_size), refresh)
+                ref_lms = cache.get_or_extend(stable_key, 'ref_landmarks', len(imgs), lambda start, stop: \
+                    self.kp_extractor.extract_keypoint([Image.fromarray(img) for img in imgs_enhanced[start:stop]],
+                                                       boxes=crop_rects[start:stop], tracker=tracker_from_options(args)), refresh)
+            profiler.add_frames('enhance', len(imgs))
+            frame_lm5 = [None if points is None else crop_to_frame(points, cox) for points in lm5]
+            gen = datagen(imgs_enhanced, mel_chunks, frames, cox, args, kp_extractor=self.kp_extractor,
+                          detector=self.face_detector, lms=ref_lms, rects=face_rects[:len(imgs)], landmarks=frame_lm5)
+
+            with stage('lip_sync'):
+                instance = self.get_ganimation() if args.up_face != 'original' else None
+                lip_synthesis(gen, len(mel_chunks), frames[0].shape[:-1], fps, self.model, self.restorer, self.enhancer,
+                              args, device, instance=instance, restorer_lock=self.restorer_lock,
+                              progress=lambda done: report('lip_sync', done), profiler=profiler)
+            profiler.add_frames('lip_sync', len(mel_chunks))
+            print('outfile:', args.outfile)
+            return args.outfile
+        finally:
+            # also written for a failed run, up to the stage that failed
+            if args.timing_report:
+                profiler.save(args.timing_report)
+            profiler.export_prometheus()
+
+
+def read_frames(args):
+    """Step 0: open ``args.face``; its frames are decoded on demand with ``args.crop`` applied."""
     if not os.path.isfile(args.face):
         raise ValueError('--face argument must be a valid path to video/image file')
-    elif args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-        full_frames = [cv2.imread(args.face)]
-        fps = args.fps
-    else:
-        video_stream = cv2.VideoCapture(args.face)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
-
-        full_frames = []
-        while True:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break
-            y1, y2, x1, x2 = args.crop
-            if x2 == -1: x2 = frame.shape[1]
-            if y2 == -1: y2 = frame.shape[0]
-            frame = frame[y1:y2, x1:x2]
-            full_frames.append(frame)
-
-    print ("[Step 0] Number of frames available for inference: "+str(len(full_frames)))
-    # face detection & cropping, cropping the first frame as the style of FFHQ
-    croper = Croper('checkpoints/shape_predictor_68_face_landmarks.dat')
-    full_frames_RGB = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in full_frames]
-    full_frames_RGB, crop, quad = croper.crop(full_frames_RGB, xsize=512)
-
-    clx, cly, crx, cry = crop
-    lx, ly, rx, ry = quad
-    lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-    oy1, oy2, ox1, ox2 = cly+ly, min(cly+ry, full_frames[0].shape[0]), clx+lx, min(clx+rx, full_frames[0].shape[1])
+    frames = FrameReader(args.face, args.crop, fps=args.fps)
+    if frames.static:
+        args.static = True
+    return frames
+
+
+def find_crop(frames, croper):
+    """Face detection, cropping the first frame with a face as the style of FFHQ: ``[crop, quad]``."""
+    found = croper.find_crop((cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in frames.iter(stop=max(frames.frame_count // 2, 1))),
+                             xsize=512)
+    if found is not None:
+        return list(found)
+    raise ValueError('Face not detected in the first half of the video! Ensure the video contains a face.')
+
+
+def crop_frames(frames, crop, quad):
+    """Cut the region found by ``find_crop`` out of every frame."""
+    clx, cly, crx, cry = [int(v) for v in crop]
+    lx, ly, rx, ry = [int(v) for v in quad]
+    frames_pil = []
+    for frame in frames:
+        frame_h, frame_w = frame.shape[:2]
+        face = cv2.cvtColor(frame[cly:cry, clx:crx][ly:ry, lx:rx], cv2.COLOR_BGR2RGB)
+        frames_pil.append(Image.fromarray(cv2.resize(face,(256,256))))
+    oy1, oy2, ox1, ox2 = cly+ly, min(cly+ry, frame_h), clx+lx, min(clx+rx, frame_w)
     # original_size = (ox2 - ox1, oy2 - oy1)
-    frames_pil = [Image.fromarray(cv2.resize(frame,(256,256))) for frame in full_frames_RGB]
+    return frames_pil, (oy1, oy2, ox1, ox2)
+
+
+def detect_frame_rects(frames, start, stop, args, detector=None, profiler=None):
+    """Raw face boxes of the frames ``[start, stop)``, ``(-1, -1, -1, -1)`` where no face is found."""
+    profiler = profiler if profiler is not None else StageProfiler()
+    # the tracker follows the face from one chunk to the next
+    tracker = tracker_from_options(args)
+    rects = []
+    for chunk in frames.chunks(args.frame_chunk_size, start, stop):
+        with profiler.stage('face_detection', frames=len(chunk)):
+            rects.extend((-1, -1, -1, -1) if rect is None else rect for rect in detect_face_rects(chunk, args, detector, tracker))
+    if tracker is not None:
+        print('[Tracking] Face detected on {keyframes} keyframes, followed on {tracked} frames.'.format(**tracker.stats()))
+    return rects
+
+
+def extract_landmarks(frames_pil, kp_extractor, boxes=None, tracker=None):
+    """Step 1: get the landmark according to the detected face, ``boxes`` being the known faces of ``frames_pil``.
+    With a ``tracker`` FAN only runs on its keyframes."""
+    print('[Step 1] Landmarks Extraction in Video.')
+    lm = kp_extractor.extract_keypoint(frames_pil, boxes=boxes, tracker=tracker).astype(np.float32)
+    if tracker is not None:
+        print('[Tracking] Landmarks regressed on {keyframes} keyframes, followed on {tracked} frames.'.format(**tracker.stats()))
+    return lm
+
+
+def extract_coeffs(frames_pil, lm, net_recon, lm3d_std, device, batch_size=16, workers=None):
+    """Step 2: 3DMM coefficients of every frame.
+
+    The frames are aligned by a pool of ``workers`` threads, one batch ahead of ``net_recon`` which
+    runs on ``batch_size`` frames at a time.
+    """
+    def align(idx):
+        frame = frames_pil[idx]
+        W, H = frame.size
+        lm_idx = lm[idx].reshape([-1, 2]).copy()
+        if np.mean(lm_idx) == -1:
+            lm_idx = (lm3d_std[:, :2]+1) / 2.
+            lm_idx = np.concatenate([lm_idx[:, :1] * W, lm_idx[:, 1:2] * H], 1)
+        else:
+            lm_idx[:, -1] = H - 1 - lm_idx[:, -1]
 
-    # get the landmark according to the detected face.
-    if not os.path.isfile('temp/'+base_name+'_landmarks.txt') or args.re_preprocess:
-        print('[Step 1] Landmarks Extraction in Video.')
-        kp_extractor = KeypointExtractor()
-        lm = kp_extractor.extract_keypoint(frames_pil, './temp/'+base_name+'_landmarks.txt')
-    else:
-        print('[Step 1] Using saved landmarks.')
-        lm = np.loadtxt('temp/'+base_name+'_landmarks.txt').astype(np.float32)
-        lm = lm.reshape([len(full_frames), -1, 2])
-       
-    if not os.path.isfile('temp/'+base_name+'_coeffs.npy') or args.exp_img is not None or args.re_preprocess:
-        net_recon = load_face3d_net(args.face3d_net_path, device)
-        lm3d_std = load_lm3d('checkpoints/BFM')
-
-        video_coeffs = []
-        for idx in tqdm(range(len(frames_pil)), desc="[Step 2] 3DMM Extraction In Video:"):
-            frame = frames_pil[idx]
-            W, H = frame.size
-            lm_idx = lm[idx].reshape([-1, 2])
-            if np.mean(lm_idx) == -1:
-                lm_idx = (lm3d_std[:, :2]+1) / 2.
-                lm_idx = np.concatenate([lm_idx[:, :1] * W, lm_idx[:, 1:2] * H], 1)
-            else:
-                lm_idx[:, -1] = H - 1 - lm_idx[:, -1]
-
-            trans_params, im_idx, lm_idx, _ = align_img(frame, lm_idx, lm3d_std)
-            trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-            im_idx_tensor = torch.tensor(np.array(im_idx)/255., dtype=torch.float32).permute(2, 0, 1).to(device).unsqueeze(0) 
+        trans_params, im_idx, lm_idx, _ = align_img(frame, lm_idx, lm3d_std)
+        trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+        return trans_params, np.array(im_idx)
+
+    batches = [range(start, min(start + batch_size, len(frames_pil))) for start in range(0, len(frames_pil), batch_size)]
+    video_coeffs = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        pending = [pool.submit(align, idx) for idx in batches[0]] if batches else []
+        for i in tqdm(range(len(batches)), desc="[Step 2] 3DMM Extraction In Video:"):
+            aligned = [future.result() for future in pending]
+            if i + 1 < len(batches):
+                pending = [pool.submit(align, idx) for idx in batches[i + 1]]
+
+            im_tensor = torch.tensor(np.stack([im_idx for _, im_idx in aligned])/255., dtype=torch.float32).permute(0, 3, 1, 2).to(device)
             with torch.no_grad():
-                coeffs = split_coeff(net_recon(im_idx_tensor))
+                coeffs = split_coeff(net_recon(im_tensor))
 
             pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
             pred_coeff = np.concatenate([pred_coeff['id'], pred_coeff['exp'], pred_coeff['tex'], pred_coeff['angle'],\
-                                         pred_coeff['gamma'], pred_coeff['trans'], trans_params[None]], 1)
+                                         pred_coeff['gamma'], pred_coeff['trans'], np.stack([params for params, _ in aligned])], 1)
             video_coeffs.append(pred_coeff)
-        semantic_npy = np.array(video_coeffs)[:,0]
-        np.save('temp/'+base_name+'_coeffs.npy', semantic_npy)
-    else:
-        print('[Step 2] Using saved coeffs.')
-        semantic_npy = np.load('temp/'+base_name+'_coeffs.npy').astype(np.float32)
+    return np.concatenate(video_coeffs, 0)
 
-    # generate the 3dmm coeff from a single image
+
+def load_expression(args, expressions, kp_extractor, net_recon, lm3d_std, device):
+    """The target expression: from ``args.exp_img`` if it is an image, else a template of ``expression.mat``."""
     if args.exp_img is not None and ('.png' in args.exp_img or '.jpg' in args.exp_img):
+        # generate the 3dmm coeff from a single image
         print('extract the exp from',args.exp_img)
         exp_pil = Image.open(args.exp_img).convert('RGB')
-        lm3d_std = load_lm3d('third_part/face3d/BFM')
-        
+
         W, H = exp_pil.size
-        kp_extractor = KeypointExtractor()
-        lm_exp = kp_extractor.extract_keypoint([exp_pil], 'temp/'+base_name+'_temp.txt')[0]
+        lm_exp = kp_extractor.extract_keypoint([exp_pil])[0]
         if np.mean(lm_exp) == -1:
             lm_exp = (lm3d_std[:, :2] + 1) / 2.
             lm_exp = np.concatenate(
@@ -137,188 +293,272 @@ def main():
         im_exp_tensor = torch.tensor(np.array(im_exp)/255., dtype=torch.float32).permute(2, 0, 1).to(device).unsqueeze(0)
         with torch.no_grad():
             expression = split_coeff(net_recon(im_exp_tensor))['exp'][0]
-        del net_recon
     elif args.exp_img == 'smile':
-        expression = torch.tensor(loadmat('checkpoints/expression.mat')['expression_mouth'])[0]
+        expression = torch.tensor(expressions['expression_mouth'])[0]
     else:
         print('using expression center')
-        expression = torch.tensor(loadmat('checkpoints/expression.mat')['expression_center'])[0]
-
-    # load DNet, model(LNet and ENet)
-    D_Net, model = load_model(args, device)
-
-    if not os.path.isfile('temp/'+base_name+'_stablized.npy') or args.re_preprocess:
-        imgs = []
-        for idx in tqdm(range(len(frames_pil)), desc="[Step 3] Stabilize the expression In Video:"):
-            if args.one_shot:
-                source_img = trans_image(frames_pil[0]).unsqueeze(0).to(device)
-                semantic_source_numpy = semantic_npy[0:1]
-            else:
-                source_img = trans_image(frames_pil[idx]).unsqueeze(0).to(device)
-                semantic_source_numpy = semantic_npy[idx:idx+1]
-            ratio = find_crop_norm_ratio(semantic_source_numpy, semantic_npy)
-            coeff = transform_semantic(semantic_npy, idx, ratio).unsqueeze(0).to(device)
-        
-            # hacking the new expression
-            coeff[:, :64, :] = expression[None, :64, None].to(device) 
-            with torch.no_grad():
-                output = D_Net(source_img, coeff)
-            img_stablized = np.uint8((output['fake_image'].squeeze(0).permute(1,2,0).cpu().clamp_(-1, 1).numpy() + 1 )/2. * 255)
-            imgs.append(cv2.cvtColor(img_stablized,cv2.COLOR_RGB2BGR)) 
-        np.save('temp/'+base_name+'_stablized.npy',imgs)
-        del D_Net
+        expression = torch.tensor(expressions['expression_center'])[0]
+    return expression
+
+
+def stabilize_expression(frames_pil, semantic_npy, expression, D_Net, args, device):
+    """Step 3: re-render every frame with the target expression through DNet, ``args.DNet_batch_size`` frames at a time."""
+    # the crop ratios and the windows of coefficients of all the frames at once
+    if args.one_shot:
+        source_img = trans_image(frames_pil[0]).unsqueeze(0).to(device)
+        ratios = find_crop_norm_ratio(semantic_npy[0:1], semantic_npy).repeat(len(frames_pil))
     else:
-        print('[Step 3] Using saved stabilized video.')
-        imgs = np.load('temp/'+base_name+'_stablized.npy')
-    torch.cuda.empty_cache()
-
-    if not args.audio.endswith('.wav'):
-        command = 'ffmpeg -loglevel error -y -i {} -strict -2 {}'.format(args.audio, 'temp/{}/temp.wav'.format(args.tmp_dir))
-        subprocess.call(command, shell=True)
-        args.audio = 'temp/{}/temp.wav'.format(args.tmp_dir)
-    wav = audio.load_wav(args.audio, 16000)
-    mel = audio.melspectrogram(wav)
-    if np.isnan(mel.reshape(-1)).sum() > 0:
-        raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
-
-    mel_step_size, mel_idx_multiplier, i, mel_chunks = 16, 80./fps, 0, []
-    while True:
-        start_idx = int(i * mel_idx_multiplier)
-        if start_idx + mel_step_size > len(mel[0]):
-            mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-            break
-        mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-        i += 1
-
-    print("[Step 4] Load audio; Length of mel chunks: {}".format(len(mel_chunks)))
-    imgs = imgs[:len(mel_chunks)]
-    full_frames = full_frames[:len(mel_chunks)]  
-    lm = lm[:len(mel_chunks)]
-    
-    imgs_enhanced = []
-    for idx in tqdm(range(len(imgs)), desc='[Step 5] Reference Enhancement'):
-        img = imgs[idx]
-        pred, _, _ = enhancer.process(img, img, face_enhance=True, possion_blending=False)
-        imgs_enhanced.append(pred)
-    gen = datagen(imgs_enhanced.copy(), mel_chunks, full_frames, None, (oy1,oy2,ox1,ox2))
-
-    frame_h, frame_w = full_frames[0].shape[:-1]
-    out = cv2.VideoWriter('temp/{}/result.mp4'.format(args.tmp_dir), cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame_w, frame_h))
-    
-    if args.up_face != 'original':
-        instance = GANimationModel()
-        instance.initialize()
-        instance.setup()
-
-    kp_extractor = KeypointExtractor()
-    for i, (img_batch, mel_batch, frames, coords, img_original, f_frames) in enumerate(tqdm(gen, desc='[Step 6] Lip Synthesis:', total=int(np.ceil(float(len(mel_chunks)) / args.LNet_batch_size)))):
-        img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-        mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-        img_original = torch.FloatTensor(np.transpose(img_original, (0, 3, 1, 2))).to(device)/255. # BGR -> RGB
-        
+        ratios = self_crop_norm_ratios(semantic_npy)
+
+    imgs = []
+    batch_size = args.DNet_batch_size
+    for start in tqdm(range(0, len(frames_pil), batch_size), desc="[Step 3] Stabilize the expression In Video:"):
+        indices = np.arange(start, min(start + batch_size, len(frames_pil)))
+        if args.one_shot:
+            source_imgs = source_img.expand(len(indices), -1, -1, -1)
+        else:
+            source_imgs = torch.stack([trans_image(frames_pil[idx]) for idx in indices]).to(device)
+        coeff = transform_semantic_batch(semantic_npy, indices, ratios[indices]).to(device)
+
+        # hacking the new expression
+        coeff[:, :64, :] = expression[None, :64, None].to(device)
         with torch.no_grad():
-            incomplete, reference = torch.split(img_batch, 3, dim=1) 
-            pred, low_res = model(mel_batch, img_batch, reference)
-            pred = torch.clamp(pred, 0, 1)
-
-            if args.up_face in ['sad', 'angry', 'surprise']:
-                tar_aus = exp_aus_dict[args.up_face]
-            else:
-                pass
-            
-            if args.up_face == 'original':
-                cur_gen_faces = img_original
-            else:
-                test_batch = {'src_img': torch.nn.functional.interpolate((img_original * 2 - 1), size=(128, 128), mode='bilinear'), 
-                              'tar_aus': tar_aus.repeat(len(incomplete), 1)}
-                instance.feed_batch(test_batch)
-                instance.forward()
-                cur_gen_faces = torch.nn.functional.interpolate(instance.fake_img / 2. + 0.5, size=(384, 384), mode='bilinear')
-                
-            if args.without_rl1 is not False:
-                incomplete, reference = torch.split(img_batch, 3, dim=1)
-                mask = torch.where(incomplete==0, torch.ones_like(incomplete), torch.zeros_like(incomplete)) 
-                pred = pred * mask + cur_gen_faces * (1 - mask) 
-        
-        pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-
-        torch.cuda.empty_cache()
-        for p, f, xf, c in zip(pred, frames, f_frames, coords):
-            y1, y2, x1, x2 = c
-            p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-            
-            ff = xf.copy() 
-            ff[y1:y2, x1:x2] = p
-            
-            # month region enhancement by GFPGAN
-            cropped_faces, restored_faces, restored_img = restorer.enhance(
-                ff, has_aligned=False, only_center_face=True, paste_back=True)
-                # 0,   1,   2,   3,   4,   5,   6,   7,   8,  9, 10,  11,  12,
-            mm = [0,   0,   0,   0,   0,   0,   0,   0,   0,  0, 255, 255, 255, 0, 0, 0, 0, 0, 0]
-            mouse_mask = np.zeros_like(restored_img)
-            tmp_mask = enhancer.faceparser.process(restored_img[y1:y2, x1:x2], mm)[0]
-            mouse_mask[y1:y2, x1:x2]= cv2.resize(tmp_mask, (x2 - x1, y2 - y1))[:, :, np.newaxis] / 255.
-
-            height, width = ff.shape[:2]
-            restored_img, ff, full_mask = [cv2.resize(x, (512, 512)) for x in (restored_img, ff, np.float32(mouse_mask))]
-            img = Laplacian_Pyramid_Blending_with_mask(restored_img, ff, full_mask[:, :, 0], 10)
-            pp = np.uint8(cv2.resize(np.clip(img, 0 ,255), (width, height)))
-
-            pp, orig_faces, enhanced_faces = enhancer.process(pp, xf, bbox=c, face_enhance=False, possion_blending=True)
-            out.write(pp)
-    out.release()
-    
-    if not os.path.isdir(os.path.dirname(args.outfile)):
-        os.makedirs(os.path.dirname(args.outfile), exist_ok=True)
-    command = 'ffmpeg -loglevel error -y -i {} -i {} -strict -2 -q:v 1 {}'.format(args.audio, 'temp/{}/result.mp4'.format(args.tmp_dir), args.outfile)
-    subprocess.call(command, shell=platform.system() != 'Windows')
-    print('outfile:', args.outfile)
+            output = D_Net(source_imgs, coeff)
+        img_stablized = np.uint8((output['fake_image'].permute(0,2,3,1).cpu().clamp_(-1, 1).numpy() + 1 )/2. * 255)
+        imgs.extend(cv2.cvtColor(img, cv2.COLOR_RGB2BGR) for img in img_stablized)
+    return np.array(imgs)
+
+
+def load_mel_chunks(args, fps, cache=None, refresh=False):
+    """Step 4: the mel spectrogram of ``args.audio`` split into one chunk per video frame.
+
+    The spectrogram is cached by the content of the audio, the chunks are views into it for ``fps``.
+    """
+    cache = cache if cache is not None else PreprocessCache()
+    frontend = getattr(args, 'mel_frontend', None) or audio.hp.mel_frontend
+
+    def compute():
+        wav = audio.load_audio(args.audio, 16000)
+        mel = audio.melspectrogram(wav, frontend)
+        if np.isnan(mel.reshape(-1)).sum() > 0:
+            raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
+        return mel
 
+    # the spectrogram also depends on the decoder and the audio hyperparameters
+    audio_key = cache.key(cache.file_key(args.audio), 'ffmpeg', sorted(audio.hp.data.items()), frontend)
+    mel = cache.get_or_compute(audio_key, 'mel', compute, refresh)
+    return audio.MelChunks(mel, fps)
 
-# frames:256x256, full_frames: original size
-def datagen(frames, mels, full_frames, frames_pil, cox):
-    img_batch, mel_batch, frame_batch, coords_batch, ref_batch, full_frame_batch = [], [], [], [], [], []
-    base_name = args.face.split('/')[-1]
-    refs = []
-    image_size = 256 
+
+def enhance_references(imgs, enhancer, boxes=None, landmarks=None, batch_size=8):
+    """Step 5: GPEN enhancement of the stabilized frames used as LNet references.
+
+    ``boxes`` and 5 point ``landmarks`` of the faces are reused instead of detected when known. The faces
+    go through GPEN and the face parser ``batch_size`` at a time.
+    """
+    faces = [None] * len(imgs)
+    for idx in range(len(imgs)):
+        if boxes is not None and landmarks is not None and boxes[idx][0] >= 0 and landmarks[idx] is not None:
+            faces[idx] = enhancer.known_faces(boxes[idx], landmarks[idx])
+
+    imgs_enhanced = []
+    for start in tqdm(range(0, len(imgs), batch_size), desc='[Step 5] Reference Enhancement'):
+        batch = imgs[start:start + batch_size]
+        # the frames without a known face are detected together by process_batch
+        results = enhancer.process_batch(batch, batch, face_enhance=True, possion_blending=False,
+                                         faces=faces[start:start + batch_size], batch_size=batch_size)
+        imgs_enhanced.extend(pred for pred, _, _ in results)
+    return imgs_enhanced
+
+
+def blend_mouths(ffs, restored_imgs, coords, enhancer, device, batch_size=16, profiler=None):
+    """Step 6: the mouths of the frames restored by GFPGAN blended into ``ffs``, the frames with the LNet faces.
+
+    The mouths of the whole batch are parsed together and blended by ``laplacian_pyramid_blending_batch``,
+    at the native resolution of the frames and only around the faces: every frame of the batch blends a
+    region of the same size centered on its face, written into ``ffs`` in place.
+
+    Returns ``ffs`` and the masks of the faces in ``coords``, from the same parsing, for ``composite_frame``.
+    """
+    profiler = profiler if profiler is not None else StageProfiler()
+    height, width = ffs[0].shape[:2]
+    regions = [feather_region(c, height, width, max(c[1] - c[0], c[3] - c[2]) // 4) for c in coords]
+    size = (max(y2 - y1 for y1, y2, _, _ in regions), max(x2 - x1 for _, _, x1, x2 in regions))
+    regions = [feather_region(c, height, width, 0, size) for c in coords]
+
+    # 0,   1,   2,   3,   4,   5,   6,   7,   8,  9, 10,  11,  12,
+    mm = np.uint8([0,   0,   0,   0,   0,   0,   0,   0,   0,  0, 255, 255, 255, 0, 0, 0, 0, 0, 0])
+    # no ear, no neck, no hair&hat, only face region, as FaceEnhancement pastes the faces
+    face_mm = np.uint8([0, 255, 255, 255, 255, 255, 255, 255, 0, 0, 255, 255, 255, 0, 0, 0, 0, 0, 0])
+    with profiler.stage('mouth_mask', frames=len(ffs)):
+        labels = enhancer.faceparser.parse_batch([img[y1:y2, x1:x2] for img, (y1, y2, x1, x2) in zip(restored_imgs, coords)],
+                                                 batch_size)
+        tmp_masks = [mm[label] for label in labels]
+        face_masks = [face_mm[label] for label in labels]
+        mouse_masks = []
+        for (y1, y2, x1, x2), (ry1, ry2, rx1, rx2), tmp_mask in zip(coords, regions, tmp_masks):
+            # uint8 like the frames, so only the pixels fully inside the mouth are kept
+            mouse_mask = np.zeros((ry2 - ry1, rx2 - rx1), dtype=np.uint8)
+            mouse_mask[y1 - ry1:y2 - ry1, x1 - rx1:x2 - rx1] = cv2.resize(tmp_mask, (x2 - x1, y2 - y1)) / 255.
+            mouse_masks.append(np.float32(mouse_mask))
+
+    with profiler.stage('blending', frames=len(ffs)):
+        restored_rois = np.stack([img[y1:y2, x1:x2] for img, (y1, y2, x1, x2) in zip(restored_imgs, regions)])
+        ff_rois = np.stack([ff[y1:y2, x1:x2] for ff, (y1, y2, x1, x2) in zip(ffs, regions)])
+        # the levels under 4 pixels change the blend by less than 0.1
+        imgs = laplacian_pyramid_blending_batch(restored_rois, ff_rois, np.stack(mouse_masks), num_levels=10, min_size=4, device=device)
+        for img, ff, (y1, y2, x1, x2) in zip(imgs, ffs, regions):
+            ff[y1:y2, x1:x2] = np.uint8(np.clip(img, 0 ,255))
+    return ffs, face_masks
+
+
+def composite_frame(pp, xf, c, face_mask, profiler):
+    """Step 6: the face of ``pp``, the frame with the restored mouth, pasted into the original frame ``xf``.
+
+    ``face_mask`` comes from the parsing of ``blend_mouths``, so the face is not detected, aligned and parsed
+    again as ``FaceEnhancement.process(pp, xf, bbox=c, face_enhance=False, possion_blending=True)`` would.
+    """
+    with profiler.stage('compositing', frames=1):
+        return composite_face(pp, xf, c, face_mask)
+
+
+def lip_synthesis(gen, num_mels, frame_size, fps, model, restorer, enhancer, args, device, instance=None,
+                  restorer_lock=None, progress=None, profiler=None):
+    """Step 6: run LNet/ENet on every batch of ``gen``, restore the mouth region and write ``args.outfile``.
+
+    The stages overlap: ``gen`` prepares the next batches on a thread of its own, LNet/ENet, GFPGAN and the
+    mouth blending run batch by batch on the calling thread, the frames are composited by a pool of
+    ``args.step6_workers`` threads and a writer thread encodes them in order. The queues between them are
+    bounded, so is the memory.
+    """
+    profiler = profiler if profiler is not None else StageProfiler()
+    if not os.path.isdir(os.path.dirname(args.outfile)):
+        os.makedirs(os.path.dirname(args.outfile), exist_ok=True)
+    restorer_lock = restorer_lock if restorer_lock is not None else threading.Lock()
+    num_batches = int(np.ceil(float(num_mels) / args.LNet_batch_size))
+    workers = args.step6_workers or os.cpu_count()
+    with FFmpegWriter(args.outfile, fps, frame_size, audio=args.audio, preset=args.encoder_preset,
+                      crf=args.encoder_crf, threads=args.encoder_threads) as out:
+        written = [0]
+
+        def write(pp):
+            with profiler.stage('encode', frames=1):
+                out.write(pp)
+            written[0] += 1
+            if progress is not None:
+                progress(min(1., written[0] / num_mels))
+
+        batches = prefetch(profiler.iterate('datagen', gen, frames=lambda batch: len(batch[0])), args.prefetch_batches)
+        # a batch is composited by the workers while LNet, GFPGAN and the blending run on the next one
+        with OrderedPool(write, workers, max_pending=workers + 2 * args.LNet_batch_size) as frames_pool:
+            for img_batch, mel_batch, frames, coords, img_original, f_frames, lm_batch in tqdm(
+                    batches, desc='[Step 6] Lip Synthesis:', total=num_batches):
+                with profiler.stage('lnet', frames=len(img_batch)):
+                    img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
+                    mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+                    img_original = torch.FloatTensor(np.transpose(img_original, (0, 3, 1, 2))).to(device)/255. # BGR -> RGB
+
+                    with torch.no_grad():
+                        incomplete, reference = torch.split(img_batch, 3, dim=1)
+                        pred, low_res = model(mel_batch, img_batch, reference)
+                        pred = torch.clamp(pred, 0, 1)
+
+                        if args.up_face in ['sad', 'angry', 'surprise']:
+                            tar_aus = exp_aus_dict[args.up_face]
+                        else:
+                            pass
+
+                        if args.up_face == 'original':
+                            cur_gen_faces = img_original
+                        else:
+                            test_batch = {'src_img': torch.nn.functional.interpolate((img_original * 2 - 1), size=(128, 128), mode='bilinear'),
+                                          'tar_aus': tar_aus.repeat(len(incomplete), 1)}
+                            instance.feed_batch(test_batch)
+                            instance.forward()
+                            cur_gen_faces = torch.nn.functional.interpolate(instance.fake_img / 2. + 0.5, size=(384, 384), mode='bilinear')
+
+                        if args.without_rl1 is not False:
+                            incomplete, reference = torch.split(img_batch, 3, dim=1)
+                            mask = torch.where(incomplete==0, torch.ones_like(incomplete), torch.zeros_like(incomplete))
+                            pred = pred * mask + cur_gen_faces * (1 - mask)
+
+                    pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+                torch.cuda.empty_cache()
+                ffs = []
+                for p, xf, c in zip(pred, f_frames, coords):
+                    y1, y2, x1, x2 = c
+                    ff = xf.copy()
+                    ff[y1:y2, x1:x2] = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
+                    ffs.append(ff)
+
+                # month region enhancement by GFPGAN, the faces of the whole batch in one forward pass
+                with restorer_lock, profiler.stage('restore', frames=len(ffs)):
+                    restored = restorer.enhance_batch(ffs, only_center_face=True, paste_back=True,
+                                                      batch_size=args.LNet_batch_size, landmarks=lm_batch)
+                pps, face_masks = blend_mouths(ffs, [restored_img for _, _, restored_img in restored], coords, enhancer,
+                                               device, args.LNet_batch_size, profiler)
+                for pp, xf, c, face_mask in zip(pps, f_frames, coords, face_masks):
+                    frames_pool.submit(composite_frame, pp, xf, c, face_mask, profiler)
+        # waits for ffmpeg to encode the frames still buffered
+        with profiler.stage('encode'):
+            out.close()
+
+
+def main():
+    args = options()
+    LipSyncEngine(args).run(args.face, args.audio)
+
+
+# frames:256x256, full_frames: FrameReader of the original size frames
+def datagen(frames, mels, full_frames, cox, args, kp_extractor=None, detector=None, lms=None, rects=None, landmarks=None):
+    img_batch, mel_batch, frame_batch, coords_batch, ref_batch, full_frame_batch, lm_batch = [], [], [], [], [], [], []
+    image_size = 256
 
     # original frames
-    kp_extractor = KeypointExtractor()
     fr_pil = [Image.fromarray(frame) for frame in frames]
-    lms = kp_extractor.extract_keypoint(fr_pil, 'temp/'+base_name+'x12_landmarks.txt')
+    if lms is None:
+        if kp_extractor is None:
+            kp_extractor = KeypointExtractor()
+        lms = kp_extractor.extract_keypoint(fr_pil, tracker=tracker_from_options(args))
     frames_pil = [ (lm, frame) for frame,lm in zip(fr_pil, lms)] # frames is the croped version of modified face
-    crops, orig_images, quads  = crop_faces(image_size, frames_pil, scale=1.0, use_fa=True)
+    # the landmarks are given, so the face alignment model of use_fa is not needed
+    crops, orig_images, quads  = crop_faces(image_size, frames_pil, scale=1.0, use_fa=False)
     inverse_transforms = [calc_alignment_coefficients(quad + 0.5, [[0, 0], [0, image_size], [image_size, image_size], [image_size, 0]]) for quad in quads]
-    del kp_extractor.detector
 
     oy1,oy2,ox1,ox2 = cox
-    face_det_results = face_detect(full_frames, args, jaw_correction=True)
+    if rects is None:
+        rects = detect_frame_rects(full_frames, 0, len(frames), args, detector)
+    face_coords = face_boxes(rects, full_frames, args, jaw_correction=True)
 
-    for inverse_transform, crop, full_frame, face_det in zip(inverse_transforms, crops, full_frames, face_det_results):
-        imc_pil = paste_image(inverse_transform, crop, Image.fromarray(
+    def reference(idx, full_frame):
+        imc_pil = paste_image(inverse_transforms[idx], crops[idx], Image.fromarray(
             cv2.resize(full_frame[int(oy1):int(oy2), int(ox1):int(ox2)], (256, 256))))
 
         ff = full_frame.copy()
         ff[int(oy1):int(oy2), int(ox1):int(ox2)] = cv2.resize(np.array(imc_pil.convert('RGB')), (ox2 - ox1, oy2 - oy1))
-        oface, coords = face_det
-        y1, y2, x1, x2 = coords
-        refs.append(ff[y1: y2, x1:x2])
+        y1, y2, x1, x2 = face_coords[idx]
+        return ff[y1: y2, x1:x2]
 
-    for i, m in enumerate(mels):
+    # the full frames are decoded while the batches are consumed, looping over the video for a longer audio
+    for i, (m, full_frame) in enumerate(zip(mels, full_frames.cycle(len(mels), len(frames)))):
         idx = 0 if args.static else i % len(frames)
         frame_to_save = frames[idx].copy()
-        face = refs[idx]
-        oface, coords = face_det_results[idx].copy()
+        face = reference(idx, full_frame)
+        coords = face_coords[idx]
+        y1, y2, x1, x2 = coords
+        oface = full_frame[y1: y2, x1:x2]
 
         face = cv2.resize(face, (args.img_size, args.img_size))
         oface = cv2.resize(oface, (args.img_size, args.img_size))
 
         img_batch.append(oface)
-        ref_batch.append(face) 
+        ref_batch.append(face)
         mel_batch.append(m)
         coords_batch.append(coords)
         frame_batch.append(frame_to_save)
-        full_frame_batch.append(full_frames[idx].copy())
+        full_frame_batch.append(full_frame)
+        lm_batch.append(None if landmarks is None else landmarks[idx])
 
         if len(img_batch) >= args.LNet_batch_size:
             img_batch, mel_batch, ref_batch = np.asarray(img_batch), np.asarray(mel_batch), np.asarray(ref_batch)
@@ -328,8 +568,8 @@ def datagen(frames, mels, full_frames, frames_pil, cox):
             img_batch = np.concatenate((img_masked, ref_batch), axis=3) / 255.
             mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
 
-            yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch
-            img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, ref_batch  = [], [], [], [], [], [], []
+            yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, lm_batch
+            img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, ref_batch, lm_batch  = [], [], [], [], [], [], [], []
 
     if len(img_batch) > 0:
         img_batch, mel_batch, ref_batch = np.asarray(img_batch), np.asarray(mel_batch), np.asarray(ref_batch)
@@ -338,7 +578,7 @@ def datagen(frames, mels, full_frames, frames_pil, cox):
         img_masked[:, args.img_size//2:] = 0
         img_batch = np.concatenate((img_masked, ref_batch), axis=3) / 255.
         mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-        yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch
+        yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, lm_batch
 
 
 if __name__ == '__main__':
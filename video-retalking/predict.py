@@ -3,7 +3,6 @@
 
 import os
 import sys
-import argparse
 import subprocess
 import numpy as np
 from tqdm import tqdm
@@ -43,6 +42,7 @@ from utils.inference_utils import (
     find_crop_norm_ratio,
     load_face3d_net,
     exp_aus_dict,
+    default_options,
 )
 
 
@@ -81,7 +81,8 @@ class Predictor(BasePredictor):
     ) -> Path:
         """Run a single prediction on the model"""
         device = "cuda"
-        args = argparse.Namespace(
+        # the CLI defaults first, so the options added since (e.g. work_dir) are there too
+        args = default_options(
             DNet_path="checkpoints/DNet.pt",
             LNet_path="checkpoints/LNet.pth",
             ENet_path="checkpoints/ENet.pth",
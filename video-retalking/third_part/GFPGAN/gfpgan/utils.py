@@ -1,4 +1,5 @@
 import cv2
+import numpy as np
 import os
 import torch
 from basicsr.utils import img2tensor, tensor2img
@@ -110,21 +111,7 @@ class GFPGANer():
             self.face_helper.align_warp_face()
 
         # face restoration
-        for cropped_face in self.face_helper.cropped_faces:
-            # prepare data
-            cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
-            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-            cropped_face_t = cropped_face_t.unsqueeze(0).to(self.device)
-
-            try:
-                output = self.gfpgan(cropped_face_t, return_rgb=False)[0]
-                # convert to image
-                restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
-            except RuntimeError as error:
-                print(f'\tFailed inference for GFPGAN: {error}.')
-                restored_face = cropped_face
-
-            restored_face = restored_face.astype('uint8')
+        for restored_face in self.restore_faces(self.face_helper.cropped_faces):
             self.face_helper.add_restored_face(restored_face)
 
         if not has_aligned and paste_back:
@@ -141,3 +128,72 @@ class GFPGANer():
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, restored_img
         else:
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, None
+
+    @torch.no_grad()
+    def restore_faces(self, cropped_faces, batch_size=16):
+        """Run GFPGAN on aligned 512x512 BGR faces, ``batch_size`` faces per forward pass."""
+        restored_faces = []
+        for start in range(0, len(cropped_faces), batch_size):
+            batch = cropped_faces[start:start + batch_size]
+            # prepare data
+            cropped_faces_t = []
+            for cropped_face in batch:
+                cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+                normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+                cropped_faces_t.append(cropped_face_t)
+            cropped_faces_t = torch.stack(cropped_faces_t).to(self.device)
+
+            try:
+                output = self.gfpgan(cropped_faces_t, return_rgb=False)[0]
+                # convert to image
+                restored_faces.extend(
+                    tensor2img(face, rgb2bgr=True, min_max=(-1, 1)).astype('uint8') for face in output)
+            except RuntimeError as error:
+                print(f'\tFailed inference for GFPGAN: {error}.')
+                restored_faces.extend(cropped_face.astype('uint8') for cropped_face in batch)
+        return restored_faces
+
+    @torch.no_grad()
+    def enhance_batch(self, imgs, only_center_face=False, paste_back=True, batch_size=16, landmarks=None):
+        """``enhance`` of several unaligned images, with the faces of all of them restored in batches.
+
+        Args:
+            landmarks (list): 5 face landmarks ``(5, 2)`` of every image (eyes, nose, mouth corners) already
+                known, which skips the face detection. ``None`` items are detected.
+
+        Returns:
+            list: ``(cropped_faces, restored_faces, restored_img)`` of every image.
+        """
+        # detect and align every image first, keeping what the face helper needs to paste back
+        aligned = []
+        for idx, img in enumerate(imgs):
+            self.face_helper.clean_all()
+            self.face_helper.read_image(img)
+            if landmarks is not None and landmarks[idx] is not None:
+                self.face_helper.all_landmarks_5 = [np.asarray(landmarks[idx], dtype=np.float32)]
+            else:
+                self.face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
+            self.face_helper.align_warp_face()
+            aligned.append((self.face_helper.input_img, self.face_helper.affine_matrices,
+                            self.face_helper.cropped_faces))
+
+        restored = self.restore_faces([face for _, _, cropped_faces in aligned for face in cropped_faces], batch_size)
+
+        results = []
+        for img, (input_img, affine_matrices, cropped_faces) in zip(imgs, aligned):
+            restored_faces, restored = restored[:len(cropped_faces)], restored[len(cropped_faces):]
+            restored_img = None
+            if paste_back:
+                self.face_helper.clean_all()
+                self.face_helper.input_img = input_img
+                self.face_helper.affine_matrices = affine_matrices
+                self.face_helper.restored_faces = restored_faces
+                # upsample the background
+                if self.bg_upsampler is not None:
+                    bg_img = self.bg_upsampler.enhance(img, outscale=self.upscale)[0]
+                else:
+                    bg_img = None
+                self.face_helper.get_inverse_affine(None)
+                restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=bg_img)
+            results.append((cropped_faces, restored_faces, restored_img))
+        return results
@@ -17,18 +17,19 @@ class PriorBox(object):
     def forward(self):
         anchors = []
         for k, f in enumerate(self.feature_maps):
-            min_sizes = self.min_sizes[k]
-            for i, j in product(range(f[0]), range(f[1])):
-                for min_size in min_sizes:
-                    s_kx = min_size / self.image_size[1]
-                    s_ky = min_size / self.image_size[0]
-                    dense_cx = [x * self.steps[k] / self.image_size[1] for x in [j + 0.5]]
-                    dense_cy = [y * self.steps[k] / self.image_size[0] for y in [i + 0.5]]
-                    for cy, cx in product(dense_cy, dense_cx):
-                        anchors += [cx, cy, s_kx, s_ky]
+            min_sizes = np.array(self.min_sizes[k], dtype=np.float64)
+            dense_cy, dense_cx = np.meshgrid((np.arange(f[0]) + 0.5) * self.steps[k] / self.image_size[0],
+                                             (np.arange(f[1]) + 0.5) * self.steps[k] / self.image_size[1], indexing='ij')
+            # [cx, cy, s_kx, s_ky] of every min size at every position, row by row
+            anchor = np.empty((f[0] * f[1], len(min_sizes), 4))
+            anchor[..., 0] = dense_cx.reshape(-1, 1)
+            anchor[..., 1] = dense_cy.reshape(-1, 1)
+            anchor[..., 2] = min_sizes / self.image_size[1]
+            anchor[..., 3] = min_sizes / self.image_size[0]
+            anchors.append(anchor.reshape(-1, 4))
 
         # back to torch land
-        output = torch.Tensor(anchors).view(-1, 4)
+        output = torch.Tensor(np.concatenate(anchors, 0))
         if self.clip:
             output.clamp_(max=1, min=0)
         return output
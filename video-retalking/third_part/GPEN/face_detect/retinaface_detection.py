@@ -8,7 +8,7 @@ import torch.backends.cudnn as cudnn
 import numpy as np
 from face_detect.data import cfg_re50
 from face_detect.layers.functions.prior_box import PriorBox
-from face_detect.utils.nms.py_cpu_nms import py_cpu_nms
+from face_detect.utils.nms.py_cpu_nms import iou_matrix_nms
 import cv2
 from face_detect.facemodels.retinaface import RetinaFace
 from face_detect.utils.box_utils import decode, decode_landm
@@ -28,6 +28,8 @@ class RetinaFaceDetection(object):
         self.net = self.net.to(device)
 
         self.mean = torch.tensor([[[[104]], [[117]], [[123]]]]).to(device)
+        # the frames of a video all have the same size, so the priors are only built once per size
+        self._priors = {}
 
     def check_keys(self, pretrained_state_dict):
         ckpt_keys = set(pretrained_state_dict.keys())
@@ -57,48 +59,60 @@ class RetinaFaceDetection(object):
         self.net.load_state_dict(pretrained_dict, strict=False)
         self.net.eval()
     
+    def priors(self, im_height, im_width):
+        """Prior boxes of the network input size, on the device."""
+        if (im_height, im_width) not in self._priors:
+            priorbox = PriorBox(self.cfg, image_size=(im_height, im_width))
+            self._priors[(im_height, im_width)] = priorbox.forward().to(self.device)
+        return self._priors[(im_height, im_width)]
+
     def detect(self, img_raw, resize=1, confidence_threshold=0.9, nms_threshold=0.4, top_k=5000, keep_top_k=750, save_image=False):
-        img = np.float32(img_raw)
-
-        im_height, im_width = img.shape[:2]
-        ss = 1.0
-        # tricky
-        if max(im_height, im_width) > 1500:
-            ss = 1000.0/max(im_height, im_width)
-            img = cv2.resize(img, (0,0), fx=ss, fy=ss)
-            im_height, im_width = img.shape[:2]
-
-        scale = torch.Tensor([img.shape[1], img.shape[0], img.shape[1], img.shape[0]])
-        img -= (104, 117, 123)
-        img = img.transpose(2, 0, 1)
-        img = torch.from_numpy(img).unsqueeze(0)
-        img = img.to(self.device)
-        scale = scale.to(self.device)
-        
-        with torch.no_grad():
-            loc, conf, landms = self.net(img)  # forward pass
-
-        priorbox = PriorBox(self.cfg, image_size=(im_height, im_width))
-        priors = priorbox.forward()
-        priors = priors.to(self.device)
-        prior_data = priors.data
-        boxes = decode(loc.data.squeeze(0), prior_data, self.cfg['variance'])
-        boxes = boxes * scale / resize
-        boxes = boxes.cpu().numpy()
-        scores = conf.squeeze(0).data.cpu().numpy()[:, 1]
-        landms = decode_landm(landms.data.squeeze(0), prior_data, self.cfg['variance'])
-        scale1 = torch.Tensor([img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-                               img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-                               img.shape[3], img.shape[2]])
-        scale1 = scale1.to(self.device)
-        landms = landms * scale1 / resize
-        landms = landms.cpu().numpy()
-
-        # ignore low scores
-        inds = np.where(scores > confidence_threshold)[0]
-        boxes = boxes[inds]
-        landms = landms[inds]
-        scores = scores[inds]
+        return self.detect_batch([img_raw], resize, confidence_threshold, nms_threshold, top_k, keep_top_k)[0]
+
+    def detect_batch(self, imgs, resize=1, confidence_threshold=0.9, nms_threshold=0.4, top_k=5000, keep_top_k=750, batch_size=8):
+        """``detect`` of several images of the same size, ``batch_size`` of them per forward pass.
+
+        Returns a ``(dets, landms)`` pair per image.
+        """
+        results = []
+        for start in range(0, len(imgs), batch_size):
+            img = np.float32(np.stack(imgs[start:start + batch_size]))
+
+            im_height, im_width = img.shape[1:3]
+            ss = 1.0
+            # tricky
+            if max(im_height, im_width) > 1500:
+                ss = 1000.0/max(im_height, im_width)
+                img = np.stack([cv2.resize(x, (0,0), fx=ss, fy=ss) for x in img])
+                im_height, im_width = img.shape[1:3]
+
+            img -= (104, 117, 123)
+            img = img.transpose(0, 3, 1, 2)
+            img = torch.from_numpy(img).to(self.device)
+
+            with torch.no_grad():
+                loc, conf, landms = self.net(img)  # forward pass
+
+            for i in range(len(img)):
+                dets, landm = self.postprocess(loc[i], conf[i], landms[i], im_height, im_width, resize,
+                                               confidence_threshold, nms_threshold, top_k, keep_top_k)
+                results.append((dets/ss, landm/ss))
+        return results
+
+    def postprocess(self, loc, conf, landms, im_height, im_width, resize=1, confidence_threshold=0.9, nms_threshold=0.4, top_k=5000, keep_top_k=750):
+        """Boxes and landmarks of the faces found in the network outputs of one image."""
+        # ignore low scores before decoding and leaving the device
+        scores = conf[:, 1]
+        inds = torch.nonzero(scores > confidence_threshold, as_tuple=True)[0]
+        prior_data = self.priors(im_height, im_width)[inds]
+        scores = scores[inds].cpu().numpy()
+
+        scale = torch.Tensor([im_width, im_height] * 2).to(self.device)
+        boxes = decode(loc[inds], prior_data, self.cfg['variance'])
+        boxes = (boxes * scale / resize).cpu().numpy()
+        scale1 = torch.Tensor([im_width, im_height] * 5).to(self.device)
+        landms = decode_landm(landms[inds], prior_data, self.cfg['variance'])
+        landms = (landms * scale1 / resize).cpu().numpy()
 
         # keep top-K before NMS
         order = scores.argsort()[::-1][:top_k]
@@ -108,8 +122,7 @@ class RetinaFaceDetection(object):
 
         # do NMS
         dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
-        keep = py_cpu_nms(dets, nms_threshold)
-        # keep = nms(dets, nms_threshold,force_cpu=args.cpu)
+        keep = iou_matrix_nms(dets, nms_threshold)
         dets = dets[keep, :]
         landms = landms[keep]
 
@@ -117,77 +130,20 @@ class RetinaFaceDetection(object):
         dets = dets[:keep_top_k, :]
         landms = landms[:keep_top_k, :]
 
-        # sort faces(delete)
-        '''
-        fscores = [det[4] for det in dets]
-        sorted_idx = sorted(range(len(fscores)), key=lambda k:fscores[k], reverse=False) # sort index
-        tmp = [landms[idx] for idx in sorted_idx]
-        landms = np.asarray(tmp)
-        '''
-        
         landms = landms.reshape((-1, 5, 2))
         landms = landms.transpose((0, 2, 1))
         landms = landms.reshape(-1, 10, )
-        return dets/ss, landms/ss
+        return dets, landms
 
     def detect_tensor(self, img, resize=1, confidence_threshold=0.9, nms_threshold=0.4, top_k=5000, keep_top_k=750, save_image=False):
         im_height, im_width = img.shape[-2:]
         ss = 1000/max(im_height, im_width)
         img = F.interpolate(img, scale_factor=ss)
         im_height, im_width = img.shape[-2:]
-        scale = torch.Tensor([im_width, im_height, im_width, im_height]).to(self.device)
         img -= self.mean
 
         loc, conf, landms = self.net(img)  # forward pass
 
-        priorbox = PriorBox(self.cfg, image_size=(im_height, im_width))
-        priors = priorbox.forward()
-        priors = priors.to(self.device)
-        prior_data = priors.data
-        boxes = decode(loc.data.squeeze(0), prior_data, self.cfg['variance'])
-        boxes = boxes * scale / resize
-        boxes = boxes.cpu().numpy()
-        scores = conf.squeeze(0).data.cpu().numpy()[:, 1]
-        landms = decode_landm(landms.data.squeeze(0), prior_data, self.cfg['variance'])
-        scale1 = torch.Tensor([img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-                               img.shape[3], img.shape[2], img.shape[3], img.shape[2],
-                               img.shape[3], img.shape[2]])
-        scale1 = scale1.to(self.device)
-        landms = landms * scale1 / resize
-        landms = landms.cpu().numpy()
-
-        # ignore low scores
-        inds = np.where(scores > confidence_threshold)[0]
-        boxes = boxes[inds]
-        landms = landms[inds]
-        scores = scores[inds]
-
-        # keep top-K before NMS
-        order = scores.argsort()[::-1][:top_k]
-        boxes = boxes[order]
-        landms = landms[order]
-        scores = scores[order]
-
-        # do NMS
-        dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
-        keep = py_cpu_nms(dets, nms_threshold)
-        # keep = nms(dets, nms_threshold,force_cpu=args.cpu)
-        dets = dets[keep, :]
-        landms = landms[keep]
-
-        # keep top-K faster NMS
-        dets = dets[:keep_top_k, :]
-        landms = landms[:keep_top_k, :]
-
-        # sort faces(delete)
-        '''
-        fscores = [det[4] for det in dets]
-        sorted_idx = sorted(range(len(fscores)), key=lambda k:fscores[k], reverse=False) # sort index
-        tmp = [landms[idx] for idx in sorted_idx]
-        landms = np.asarray(tmp)
-        '''
-        
-        landms = landms.reshape((-1, 5, 2))
-        landms = landms.transpose((0, 2, 1))
-        landms = landms.reshape(-1, 10, )
+        dets, landms = self.postprocess(loc.data.squeeze(0), conf.squeeze(0).data, landms.data.squeeze(0), im_height, im_width,
+                                        resize, confidence_threshold, nms_threshold, top_k, keep_top_k)
         return dets/ss, landms/ss
@@ -36,3 +36,27 @@ def py_cpu_nms(dets, thresh):
         order = order[inds + 1]
 
     return keep
+
+def iou_matrix_nms(dets, thresh, max_boxes=256):
+    """Same boxes as ``py_cpu_nms``, with the overlaps of every pair of boxes computed at once
+    instead of one row per kept box. The (N, N) overlaps only pay off for the few boxes left
+    after the confidence threshold, more than ``max_boxes`` boxes go to ``py_cpu_nms``."""
+    if len(dets) > max_boxes:
+        return py_cpu_nms(dets, thresh)
+    order = dets[:, 4].argsort()[::-1]
+    x1, y1, x2, y2 = (dets[order, i].astype(np.float32) for i in range(4))
+
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    w = np.maximum(0.0, np.minimum(x2[:, None], x2) - np.maximum(x1[:, None], x1) + 1)
+    h = np.maximum(0.0, np.minimum(y2[:, None], y2) - np.maximum(y1[:, None], y1) + 1)
+    inter = w * h
+    ovr = inter / (areas[:, None] + areas - inter)
+
+    keep = []
+    suppressed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(order[i])
+        suppressed |= ovr[i] > thresh
+    return keep
@@ -35,21 +35,38 @@ class FaceGAN(object):
         with torch.no_grad():
             out, __ = self.model(img_t)
 
-        out = self.tensor2img(out)
+        out = self.tensor2img(out)[0]
 
         return out
 
+    def process_batch(self, imgs, batch_size=8):
+        """``process`` of several faces, ``batch_size`` of them per forward pass of the generator."""
+        outs = []
+        for i in range(0, len(imgs), batch_size):
+            batch = np.stack([cv2.resize(img, (self.resolution, self.resolution)) for img in imgs[i:i + batch_size]])
+            img_t = self.img2tensor(batch)
+
+            with torch.no_grad():
+                out, __ = self.model(img_t)
+
+            outs.extend(self.tensor2img(out))
+        return outs
+
     def img2tensor(self, img):
+        """``(H, W, 3)`` BGR image, or ``(B, H, W, 3)`` batch of them, to a ``(B, 3, H, W)`` RGB tensor."""
         img_t = torch.from_numpy(img).to(self.device)/255.
         if self.is_norm:
             img_t = (img_t - 0.5) / 0.5
-        img_t = img_t.permute(2, 0, 1).unsqueeze(0).flip(1) # BGR->RGB
+        if img_t.dim() == 3:
+            img_t = img_t.unsqueeze(0)
+        img_t = img_t.permute(0, 3, 1, 2).flip(1) # BGR->RGB
         return img_t
 
     def tensor2img(self, img_t, pmax=255.0, imtype=np.uint8):
+        """``(B, 3, H, W)`` RGB tensor to a ``(B, H, W, 3)`` batch of BGR images."""
         if self.is_norm:
             img_t = img_t * 0.5 + 0.5
-        img_t = img_t.squeeze(0).permute(1, 2, 0).flip(2) # RGB->BGR
+        img_t = img_t.permute(0, 2, 3, 1).flip(3) # RGB->BGR
         img_np = np.clip(img_t.float().cpu().numpy(), 0, 1) * pmax
 
         return img_np.astype(imtype)
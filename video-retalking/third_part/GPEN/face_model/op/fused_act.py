@@ -7,7 +7,7 @@ import torch.nn.functional as F
 from torch.autograd import Function
 from torch.utils.cpp_extension import load, _import_module_from_library
 
-# if running GPEN without cuda, please comment line 11-19
+# the CUDA kernels are only compiled with CUDA, the CPU runs fused_leaky_relu_native
 if platform.system() == 'Linux' and torch.cuda.is_available():
     module_path = os.path.dirname(__file__)
     fused = load(
@@ -93,4 +93,12 @@ def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5, device='cp
     if platform.system() == 'Linux' and torch.cuda.is_available() and device != 'cpu':
         return FusedLeakyReLUFunction.apply(input, bias, negative_slope, scale)
     else:
-        return scale * F.leaky_relu(input + bias.view((1, -1)+(1,)*(len(input.shape)-2)), negative_slope=negative_slope)
+        return fused_leaky_relu_native(input, bias, negative_slope, scale)
+
+
+def fused_leaky_relu_native(input, bias, negative_slope=0.2, scale=2 ** 0.5):
+    """``scale * leaky_relu(input + bias)``, computed in place of the sum when autograd does not need it."""
+    bias = bias.view((1, -1)+(1,)*(len(input.shape)-2))
+    if torch.is_grad_enabled() and (input.requires_grad or bias.requires_grad):
+        return scale * F.leaky_relu(input + bias, negative_slope=negative_slope)
+    return F.leaky_relu_(input + bias, negative_slope=negative_slope).mul_(scale)
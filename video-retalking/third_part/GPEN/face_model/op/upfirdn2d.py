@@ -6,7 +6,7 @@ import torch.nn.functional as F
 from torch.autograd import Function
 from torch.utils.cpp_extension import load, _import_module_from_library
 
-# if running GPEN without cuda, please comment line 10-18
+# the CUDA kernels are only compiled with CUDA, the CPU runs upfirdn2d_conv
 if platform.system() == 'Linux' and torch.cuda.is_available():
     module_path = os.path.dirname(__file__)
     upfirdn2d_op = load(
@@ -152,11 +152,40 @@ def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0), device='cpu'):
             input, kernel, (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1])
         )
     else:
-        out = upfirdn2d_native(input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1])
+        out = upfirdn2d_conv(input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1])
 
     return out
 
 
+def upfirdn2d_conv(
+    input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
+):
+    """``upfirdn2d_native`` as depthwise convolutions, without the permutes, the zeros inserted by the
+    upsampling and the samples thrown away by the downsampling.
+
+    A transposed convolution of stride ``up`` upsamples and filters at once, a convolution of stride
+    ``down`` only computes the samples that are kept.
+    """
+    channel = input.shape[1]
+    kernel_h, kernel_w = kernel.shape
+    kernel = kernel.to(input)
+
+    if up_x == 1 and up_y == 1:
+        out = F.pad(input, [pad_x0, pad_x1, pad_y0, pad_y1])
+        w = torch.flip(kernel, [0, 1]).view(1, 1, kernel_h, kernel_w).expand(channel, 1, kernel_h, kernel_w)
+        return F.conv2d(out, w, stride=(down_y, down_x), groups=channel)
+
+    in_h, in_w = input.shape[2:]
+    out_h = in_h * up_y + pad_y0 + pad_y1 - kernel_h + 1
+    out_w = in_w * up_x + pad_x0 + pad_x1 - kernel_w + 1
+    w = kernel.view(1, 1, kernel_h, kernel_w).expand(channel, 1, kernel_h, kernel_w)
+    out = F.conv_transpose2d(input, w, stride=(up_y, up_x), groups=channel)
+    # out[t] = sum_i input[i] * kernel[t - i * up], the sample y of upfirdn2d_native is out[y + kernel - 1 - pad0]
+    y0, x0 = pad_y0 - kernel_h + 1, pad_x0 - kernel_w + 1
+    out = F.pad(out, [x0, out_w - out.shape[3] - x0, y0, out_h - out.shape[2] - y0])
+    return out[:, :, ::down_y, ::down_x]
+
+
 def upfirdn2d_native(
     input, kernel, up_x, up_y, down_x, down_y, pad_x0, pad_x1, pad_y0, pad_y1
 ):
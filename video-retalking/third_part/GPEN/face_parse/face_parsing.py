@@ -49,6 +49,22 @@ class FaceParse(object):
 
         return mask
 
+    def process_batch(self, ims, masks=[0, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 0, 0, 0, 0, 0, 0], batch_size=8):
+        """``process`` of several faces, ``batch_size`` of them per forward pass of the parser."""
+        colors = np.asarray(masks, dtype=np.uint8)
+        return [colors[labels] for labels in self.parse_batch(ims, batch_size)]
+
+    def parse_batch(self, ims, batch_size=8):
+        """The class of every pixel of several faces, ``(512, 512)`` uint8 maps to index the masks of ``process`` with."""
+        labels = []
+        for i in range(0, len(ims), batch_size):
+            imt = torch.cat([self.img2tensor(cv2.resize(im, (self.size, self.size))) for im in ims[i:i + batch_size]])
+            with torch.no_grad():
+                pred_mask, sr_img_tensor = self.faceparse(imt)  # (B, 19, 512, 512)
+            labels.extend(pred_mask.argmax(dim=1).byte().cpu().numpy())
+
+        return labels
+
     def process_tensor(self, imt):
         imt = F.interpolate(imt.flip(1)*2-1, (self.size, self.size))
         pred_mask, sr_img_tensor = self.faceparse(imt)
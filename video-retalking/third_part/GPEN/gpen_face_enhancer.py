@@ -8,7 +8,7 @@ from face_parse.face_parsing import FaceParse
 from face_model.face_gan import FaceGAN
 # from sr_model.real_esrnet import RealESRNet
 from align_faces import warp_and_crop_face, get_reference_facial_points
-from utils.inference_utils import Laplacian_Pyramid_Blending_with_mask
+from utils.inference_utils import Laplacian_Pyramid_Blending_with_mask, feather_region, pyramid_levels
 
 class FaceEnhancement(object):
     def __init__(self, base_dir='./', size=512, model=None, use_sr=True, sr_model=None, channel_multiplier=2, narrow=1, device='cuda'):
@@ -46,65 +46,131 @@ class FaceEnhancement(object):
         mask = cv2.GaussianBlur(mask, (101, 101), 11)
         return mask.astype(np.float32)
     
-    def process(self, img, ori_img, bbox=None, face_enhance=True, possion_blending=False):
+    @staticmethod
+    def known_faces(box, points):
+        """``facedetector.detect`` output for a face already found: its ``(x1, y1, x2, y2)`` box and 5 points ``(5, 2)``."""
+        facebs = np.array([list(box[:4]) + [1.]], dtype=np.float32)
+        landms = np.asarray(points, dtype=np.float32).T.reshape(1, 10)
+        return facebs, landms
+
+    def process(self, img, ori_img, bbox=None, face_enhance=True, possion_blending=False, faces=None):
+        return self.process_batch([img], [ori_img], [bbox], face_enhance, possion_blending, [faces])[0]
+
+    def process_batch(self, imgs, ori_imgs, bboxes=None, face_enhance=True, possion_blending=False, faces=None, batch_size=8):
+        """``process`` of several images: the faces of all of them go through the generator and the parser
+        ``batch_size`` at a time, then they are pasted back image by image.
+
+        ``bboxes`` and ``faces`` are lists with an entry (or ``None``) per image; the images without ``faces``
+        are detected together.
+        """
+        imgs = list(imgs)
+        bboxes = bboxes if bboxes is not None else [None] * len(imgs)
+        faces = list(faces) if faces is not None else [None] * len(imgs)
+
+        imgs_sr = [None] * len(imgs)
         if self.use_sr:
-            img_sr = self.srmodel.process(img)
-            if img_sr is not None:
-                img = cv2.resize(img, img_sr.shape[:2][::-1])
-
-        facebs, landms = self.facedetector.detect(img.copy())
-
-        orig_faces, enhanced_faces = [], []
-        height, width = img.shape[:2]
-        full_mask = np.zeros((height, width), dtype=np.float32)
-        full_img = np.zeros(ori_img.shape, dtype=np.uint8)
-
-        for i, (faceb, facial5points) in enumerate(zip(facebs, landms)):
+            for i, img in enumerate(imgs):
+                imgs_sr[i] = self.srmodel.process(img)
+                if imgs_sr[i] is not None:
+                    imgs[i] = cv2.resize(img, imgs_sr[i].shape[:2][::-1])
+
+        # faces: (facebs, landms) as returned by the detector, e.g. from known_faces
+        unknown = [i for i in range(len(imgs)) if faces[i] is None]
+        for i, detected in zip(unknown, self.facedetector.detect_batch([imgs[i] for i in unknown])):
+            faces[i] = detected
+
+        crops = [self.crop_faces(img, facebs, landms) for img, (facebs, landms) in zip(imgs, faces)]
+        orig_faces = [of for img_crops in crops for _, of, _ in img_crops]
+
+        # enhance the faces
+        enhanced_faces = self.facegan.process_batch(orig_faces, batch_size) if face_enhance else orig_faces
+
+        '''
+        0: 'background' 1: 'skin'   2: 'nose'
+        3: 'eye_g'  4: 'l_eye'  5: 'r_eye'
+        6: 'l_brow' 7: 'r_brow' 8: 'l_ear'
+        9: 'r_ear'  10: 'mouth' 11: 'u_lip'
+        12: 'l_lip' 13: 'hair'  14: 'hat'
+        15: 'ear_r' 16: 'neck_l'    17: 'neck'
+        18: 'cloth'
+        '''
+
+        # no ear, no neck, no hair&hat,  only face region
+        mm = [0, 255, 255, 255, 255, 255, 255, 255, 0, 0, 255, 255, 255, 0, 0, 0, 0, 0, 0]
+        masks = self.faceparser.process_batch(enhanced_faces, mm, batch_size)
+
+        results, first = [], 0
+        for img, ori_img, bbox, img_sr, img_crops in zip(imgs, ori_imgs, bboxes, imgs_sr, crops):
+            last = first + len(img_crops)
+            img = self.paste_faces(img, ori_img, img_crops, enhanced_faces[first:last], masks[first:last],
+                                   bbox, face_enhance, possion_blending, img_sr)
+            results.append((img, orig_faces[first:last], enhanced_faces[first:last]))
+            first = last
+        return results
+
+    def crop_faces(self, img, facebs, landms):
+        """The ``(faceb, aligned crop, inverse transform)`` of the faces of ``img`` above the threshold."""
+        crops = []
+        for faceb, facial5points in zip(facebs, landms):
             if faceb[4]<self.threshold: continue
-            fh, fw = (faceb[3]-faceb[1]), (faceb[2]-faceb[0])
 
             facial5points = np.reshape(facial5points, (2, 5))
 
             of, tfm_inv = warp_and_crop_face(img, facial5points, reference_pts=self.reference_5pts, crop_size=(self.size, self.size))
+            crops.append((faceb, of, tfm_inv))
+        return crops
+
+    def paste_region(self, crops, height, width):
+        """The ``(y1, y2, x1, x2)`` box of a ``height`` x ``width`` frame covered by the faces of ``crops`` warped back."""
+        corners = np.array([[[0, 0], [self.size, 0], [0, self.size], [self.size, self.size]]], dtype=np.float64)
+        points = np.concatenate([cv2.transform(corners, tfm_inv)[0] for _, _, tfm_inv in crops])
+        x1, y1 = np.floor(points.min(0)).astype(int)
+        x2, y2 = np.ceil(points.max(0)).astype(int)
+        return max(y1, 0), min(y2, height), max(x1, 0), min(x2, width)
+
+    def paste_faces(self, img, ori_img, crops, enhanced_faces, masks, bbox=None, face_enhance=True, possion_blending=False, img_sr=None):
+        """Blend the ``enhanced_faces`` of the ``crops`` of ``img``, with their parsing ``masks``, into ``ori_img``.
+
+        Only the region of the frame around the faces (or around ``bbox`` for the Poisson blending) is
+        composited, at native resolution; the rest of the frame is passed through.
+        """
+        height, width = img.shape[:2]
+        use_sr = self.use_sr and img_sr is not None
+        region = self.paste_region(crops, height, width)
+        margin = 8 # the bicubic warps and the blur of mask_sharp
+        if possion_blending is True and not use_sr:
+            region = bbox if bbox is not None else region
+            margin = max(region[1] - region[0], region[3] - region[2]) // 4 # the pyramid blending fades out
+        ry1, ry2, rx1, rx2 = feather_region(region, height, width, margin)
+        rh, rw = ry2 - ry1, rx2 - rx1
+        base = img_sr if use_sr else ori_img
+        base_roi = base[ry1:ry2, rx1:rx2]
+
+        full_mask = np.zeros((rh, rw), dtype=np.float32)
+        full_img = np.zeros(base_roi.shape, dtype=np.uint8)
+
+        for (faceb, of, tfm_inv), ef, mask_sharp in zip(crops, enhanced_faces, masks):
+            fh, fw = (faceb[3]-faceb[1]), (faceb[2]-faceb[0])
+            # warp straight into the region
+            tfm_inv = tfm_inv - np.array([[0, 0, rx1], [0, 0, ry1]], dtype=tfm_inv.dtype)
 
-            # enhance the face
-            if face_enhance:
-                ef = self.facegan.process(of)
-            else:
-                ef = of
-                    
-            orig_faces.append(of)
-            enhanced_faces.append(ef)
-            
             # print(ef.shape)
             # tmp_mask = self.mask
-            '''
-            0: 'background' 1: 'skin'   2: 'nose'
-            3: 'eye_g'  4: 'l_eye'  5: 'r_eye'
-            6: 'l_brow' 7: 'r_brow' 8: 'l_ear'
-            9: 'r_ear'  10: 'mouth' 11: 'u_lip'
-            12: 'l_lip' 13: 'hair'  14: 'hat'
-            15: 'ear_r' 16: 'neck_l'    17: 'neck'
-            18: 'cloth'
-            '''
-
-            # no ear, no neck, no hair&hat,  only face region
-            mm = [0, 255, 255, 255, 255, 255, 255, 255, 0, 0, 255, 255, 255, 0, 0, 0, 0, 0, 0]
-            mask_sharp = self.faceparser.process(ef, mm)[0]/255.
+            mask_sharp = mask_sharp/255.
             tmp_mask = self.mask_postprocess(mask_sharp)
             tmp_mask = cv2.resize(tmp_mask, ef.shape[:2])
             mask_sharp = cv2.resize(mask_sharp, ef.shape[:2])
 
-            tmp_mask = cv2.warpAffine(tmp_mask, tfm_inv, (width, height), flags=3)
-            mask_sharp = cv2.warpAffine(mask_sharp, tfm_inv, (width, height), flags=3)
+            tmp_mask = cv2.warpAffine(tmp_mask, tfm_inv, (rw, rh), flags=3)
+            mask_sharp = cv2.warpAffine(mask_sharp, tfm_inv, (rw, rh), flags=3)
 
             if min(fh, fw)<100: # gaussian filter for small faces
                 ef = cv2.filter2D(ef, -1, self.kernel)
             
             if face_enhance:
-                tmp_img = cv2.warpAffine(ef, tfm_inv, (width, height), flags=3)
+                tmp_img = cv2.warpAffine(ef, tfm_inv, (rw, rh), flags=3)
             else:
-                tmp_img = cv2.warpAffine(of, tfm_inv, (width, height), flags=3)
+                tmp_img = cv2.warpAffine(of, tfm_inv, (rw, rh), flags=3)
 
             mask = tmp_mask - full_mask
             full_mask[np.where(mask>0)] = tmp_mask[np.where(mask>0)]
@@ -115,24 +181,24 @@ class FaceEnhancement(object):
         full_mask = full_mask[:, :, np.newaxis]
         mask_sharp = mask_sharp[:, :, np.newaxis]
 
-        if self.use_sr and img_sr is not None:
-            img = cv2.convertScaleAbs(img_sr*(1-full_mask) + full_img*full_mask)
+        if use_sr:
+            img = cv2.convertScaleAbs(base_roi*(1-full_mask) + full_img*full_mask)
         
         elif possion_blending is True:
             if bbox is not None:
                 y1, y2, x1, x2 = bbox
                 mask_bbox = np.zeros_like(mask_sharp)
-                mask_bbox[y1:y2 - 5, x1:x2] = 1
-                full_img, ori_img, full_mask = [cv2.resize(x,(512,512)) for x in (full_img, ori_img, np.float32(mask_sharp * mask_bbox))]
-            else:
-                full_img, ori_img, full_mask = [cv2.resize(x,(512,512)) for x in (full_img, ori_img, full_mask)]
-            
-            img = Laplacian_Pyramid_Blending_with_mask(full_img, ori_img, full_mask, 6)
-            img = np.clip(img, 0 ,255)
-            img = np.uint8(cv2.resize(img, (width, height)))
+                mask_bbox[max(y1 - ry1, 0):max(y2 - 5 - ry1, 0), max(x1 - rx1, 0):max(x2 - rx1, 0)] = 1
+                full_mask = np.float32(mask_sharp * mask_bbox)
+
+            levels = pyramid_levels((rh, rw), 6, min_size=4)
+            img = Laplacian_Pyramid_Blending_with_mask(full_img, base_roi, full_mask[:, :, 0], levels)
+            img = np.uint8(np.clip(img, 0 ,255))
 
         else:
-            img = cv2.convertScaleAbs(ori_img*(1-full_mask) + full_img*full_mask)
-            img = cv2.convertScaleAbs(ori_img*(1-mask_sharp) + img*mask_sharp)
+            img = cv2.convertScaleAbs(base_roi*(1-full_mask) + full_img*full_mask)
+            img = cv2.convertScaleAbs(base_roi*(1-mask_sharp) + img*mask_sharp)
 
-        return img, orig_faces, enhanced_faces
\ No newline at end of file
+        out = base.copy()
+        out[ry1:ry2, rx1:rx2] = img
+        return out
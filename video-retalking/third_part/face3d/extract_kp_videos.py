@@ -4,6 +4,7 @@ import time
 import glob
 import argparse
 import face_alignment
+from face_alignment.utils import crop, flip
 import numpy as np
 from PIL import Image
 import torch
@@ -11,34 +12,47 @@ from tqdm import tqdm
 from itertools import cycle
 
 from torch.multiprocessing import Pool, Process, set_start_method
+from face_detection.utils import get_preds_fromhm_batch
 
 class KeypointExtractor():
     def __init__(self):
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.detector = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, device=device)   
 
-    def extract_keypoint(self, images, name=None, info=True):
+    def extract_keypoint(self, images, name=None, info=True, boxes=None, batch_size=16, tracker=None):
+        """68 landmarks of the face of every image; ``boxes`` are known ``(x1, y1, x2, y2)`` face boxes
+        of the images, which then skip the face detector (a box starting with -1 is detected again).
+        A list of images is processed ``batch_size`` images at a time, or frame by frame with a
+        ``KeyframeTracker`` (see ``extract_keypoint_tracked``)."""
         if isinstance(images, list):
             keypoints = []
-            if info:
-                i_range = tqdm(images,desc='landmark Det:')
+            if tracker is not None:
+                batches = [self.extract_keypoint_tracked(tqdm(images, desc='landmark Det (tracking):') if info else images,
+                                                         boxes, tracker)]
             else:
-                i_range = images
+                i_range = range(0, len(images), batch_size)
+                if info:
+                    i_range = tqdm(i_range, desc='landmark Det:', unit='batch')
+                batches = (self.extract_keypoint_batch(images[start:start + batch_size],
+                                                       None if boxes is None else boxes[start:start + batch_size])
+                           for start in i_range)
 
-            for image in i_range:
-                current_kp = self.extract_keypoint(image)
-                if np.mean(current_kp) == -1 and keypoints:
-                    keypoints.append(keypoints[-1])
-                else:
-                    keypoints.append(current_kp[None])
+            for batch in batches:
+                for current_kp in batch:
+                    if np.mean(current_kp) == -1 and keypoints:
+                        keypoints.append(keypoints[-1])
+                    else:
+                        keypoints.append(current_kp[None])
 
             keypoints = np.concatenate(keypoints, 0)
-            np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
+            if name is not None:
+                np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
         else:
             while True:
                 try:
-                    keypoints = self.detector.get_landmarks_from_image(np.array(images))[0]
+                    detected_faces = None if boxes is None or boxes[0] < 0 else [np.asarray(boxes, dtype=np.float64)]
+                    keypoints = self.detector.get_landmarks_from_image(np.array(images), detected_faces=detected_faces)[0]
                     break
                 except RuntimeError as e:
                     if str(e).startswith('CUDA'):
@@ -56,6 +70,84 @@ class KeypointExtractor():
                 np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
 
+    def extract_keypoint_batch(self, images, boxes=None):
+        """``extract_keypoint`` of the first face of every image, -1 where no face is found. The images
+        without a known box go through the face detector together and all the faces through FAN together."""
+        images = [np.array(image) for image in images]
+        # float64: face_alignment's crop cannot take numpy float32 scales
+        faces = [None if boxes is None or boxes[idx][0] < 0 else np.asarray(boxes[idx], dtype=np.float64) for idx in range(len(images))]
+        while True:
+            try:
+                missing = [idx for idx, face in enumerate(faces) if face is None]
+                for idx, bboxlist in zip(missing, self.detect_faces([images[idx] for idx in missing])):
+                    faces[idx] = bboxlist[0] if len(bboxlist) else None
+                found = [idx for idx, face in enumerate(faces) if face is not None]
+                landmarks = self.face_landmarks([images[idx] for idx in found], [faces[idx] for idx in found])
+                break
+            except RuntimeError as e:
+                if str(e).startswith('CUDA'):
+                    print("Warning: out of memory, sleep for 1s")
+                    time.sleep(1)
+                else:
+                    raise
+
+        keypoints = [-1. * np.ones([68, 2]) for _ in images]
+        for idx, points in zip(found, landmarks):
+            keypoints[idx] = points
+        if len(found) < len(images):
+            print('No face detected in {} of {} images'.format(len(images) - len(found), len(images)))
+        return keypoints
+
+    def extract_keypoint_tracked(self, images, boxes, tracker):
+        """``extract_keypoint`` of consecutive frames where FAN only runs on the keyframes of ``tracker``,
+        the landmarks of the other frames being moved along by optical flow. A keyframe without a known
+        box uses the box of the landmarks of the previous frame instead of the face detector."""
+        keypoints = []
+        for idx, image in enumerate(images):
+            image = np.array(image)
+            points = tracker.follow(image)
+            if points is None:
+                box = None if boxes is None else boxes[idx]
+                if (box is None or box[0] < 0) and tracker.points is not None:
+                    box = np.concatenate([tracker.points.min(0), tracker.points.max(0)])
+                points = self.extract_keypoint_batch([image], None if box is None else [box])[0]
+                tracker.start(image, None if np.mean(points) == -1 else points)
+            keypoints.append(points)
+        return keypoints
+
+    def detect_faces(self, images):
+        """The face boxes of every image, images of the same size going through the detector in one batch."""
+        if not images:
+            return []
+        face_detector = self.detector.face_detector
+        if any(image.shape != images[0].shape for image in images):
+            return [face_detector.detect_from_image(image.copy()) for image in images]
+        return face_detector.detect_from_batch(torch.from_numpy(np.stack(images).transpose(0, 3, 1, 2)))
+
+    def face_landmarks(self, images, faces):
+        """68 landmarks of the face ``(x1, y1, x2, y2)`` of every image, in one FAN forward pass."""
+        if not images:
+            return []
+        centers, scales, inps = [], [], []
+        for image, d in zip(images, faces):
+            # same crop as face_alignment's get_landmarks_from_image
+            center = torch.tensor([d[2] - (d[2] - d[0]) / 2.0, d[3] - (d[3] - d[1]) / 2.0])
+            center[1] = center[1] - (d[3] - d[1]) * 0.12
+            scale = (d[2] - d[0] + d[3] - d[1]) / self.detector.face_detector.reference_scale
+            inps.append(crop(image, center, scale))
+            centers.append(center)
+            scales.append(scale)
+
+        inp = torch.from_numpy(np.stack(inps).transpose((0, 3, 1, 2))).float()
+        inp = inp.to(self.detector.device).div_(255.0)
+        with torch.no_grad():
+            out = self.detector.face_alignment_net(inp).detach()
+            if self.detector.flip_input:
+                out += flip(self.detector.face_alignment_net(flip(inp)).detach(), is_label=True)
+
+        _, pts_img = get_preds_fromhm_batch(out, torch.stack(centers), scales)
+        return list(pts_img.view(-1, 68, 2).cpu().numpy())
+
 def read_video(filename):
     frames = []
     cap = cv2.VideoCapture(filename)
@@ -64,6 +64,21 @@ def nms(dets, thresh):
     return keep
 
 
+def batched_nms(bboxlists, thresh):
+    """``nms`` of the boxes of several images in one pass: the boxes of every image are moved to a region of
+    their own, so that boxes of different images never overlap. Returns the kept indices of every image."""
+    sizes = [len(dets) for dets in bboxlists]
+    if sum(sizes) == 0:
+        return [[] for _ in bboxlists]
+    dets = np.concatenate([dets for dets in bboxlists if len(dets)], 0).astype(np.float64)
+    image_index = np.repeat(np.arange(len(bboxlists)), sizes)
+    offset = (dets[:, :4].max() - min(dets[:, :4].min(), 0) + 2) * image_index
+    dets[:, :4] += offset[:, None]
+    keep = np.array(nms(dets, thresh), dtype=np.int64)
+    starts = np.cumsum([0] + sizes[:-1])
+    return [list(keep[image_index[keep] == b] - starts[b]) for b in range(len(bboxlists))]
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -55,7 +55,12 @@ def detect(net, img, device):
 
     return bboxlist
 
-def batch_detect(net, imgs, device):
+def batch_detect(net, imgs, device, threshold=0.05):
+    """Detect the faces of a batch of images.
+
+    Returns, for every image, the ``(x1, y1, x2, y2, score)`` boxes of the anchors scoring above ``threshold``.
+    The anchors of all the positions of a stride are decoded at once on ``device``.
+    """
     imgs = imgs - np.array([104, 117, 123])
     imgs = imgs.transpose(0, 3, 1, 2)
 
@@ -65,36 +70,25 @@ def batch_detect(net, imgs, device):
     imgs = torch.from_numpy(imgs).float().to(device)
     BB, CC, HH, WW = imgs.size()
     with torch.no_grad():
-        # print(type(net),type(imgs), device)
         olist = net(imgs)
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    # print(olist)
-    # import pdb; pdb.set_trace()
-    olist = [oelem.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
-    if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, BB, 5))
-
-    return bboxlist
+        variances = [0.1, 0.2]
+        indices, dets = [], []
+        for i in range(len(olist) // 2):
+            ocls, oreg = F.softmax(olist[i * 2], dim=1)[:, 1], olist[i * 2 + 1]
+            stride = 2**(i + 2)    # 4,8,16,32,64,128
+            bindex, hindex, windex = torch.nonzero(ocls > threshold, as_tuple=True)
+            axc, ayc = stride / 2 + windex.float() * stride, stride / 2 + hindex.float() * stride
+            anchor = torch.full_like(axc, stride * 4)
+            priors = torch.stack([axc, ayc, anchor, anchor], 1)
+            loc = oreg[bindex, :, hindex, windex]
+            box = decode(loc.float(), priors, variances)
+            indices.append(bindex)
+            dets.append(torch.cat([box, ocls[bindex, hindex, windex].unsqueeze(1)], 1))
+        indices = torch.cat(indices).cpu().numpy()
+        dets = torch.cat(dets).cpu().numpy()
+
+    return [dets[indices == b] for b in range(BB)]
 
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
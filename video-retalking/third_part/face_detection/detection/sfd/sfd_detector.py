@@ -39,10 +39,10 @@ class SFDDetector(FaceDetector):
         return bboxlist
 
     def detect_from_batch(self, images):
-        bboxlists = batch_detect(self.face_detector, images, device=self.device)
-        keeps = [nms(bboxlists[:, i, :], 0.3) for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
-        bboxlists = [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
+        # boxes under 0.5 are dropped after nms, and can only suppress boxes scoring even less: drop them first
+        bboxlists = batch_detect(self.face_detector, images, device=self.device, threshold=0.5)
+        keeps = batched_nms(bboxlists, 0.3)
+        bboxlists = [bboxlist[keep] for bboxlist, keep in zip(bboxlists, keeps)]
 
         return bboxlists
 
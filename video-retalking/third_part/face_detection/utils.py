@@ -174,38 +174,36 @@ def get_preds_fromhm_batch(hm, centers=None, scales=None):
     and the scales is provided the function will return the points also in
     the original coordinate frame.
 
+    Same points as ``get_preds_fromhm`` for every image of the batch, computed
+    for all the heatmaps at once on the device of ``hm``.
+
     Arguments:
-        hm {torch.tensor} -- the predicted heatmaps, of shape [B, N, W, H]
+        hm {torch.tensor} -- the predicted heatmaps, of shape [B, N, H, W]
 
     Keyword Arguments:
-        centers {torch.tensor} -- the centers of the bounding box (default: {None})
-        scales {float} -- face scales (default: {None})
+        centers {torch.tensor} -- the centers of the bounding box, of shape [B, 2] (default: {None})
+        scales {torch.tensor} -- face scales, of shape [B] (default: {None})
     """
-    max, idx = torch.max(
-        hm.view(hm.size(0), hm.size(1), hm.size(2) * hm.size(3)), 2)
-    idx += 1
-    preds = idx.view(idx.size(0), idx.size(1), 1).repeat(1, 1, 2).float()
-    preds[..., 0].apply_(lambda x: (x - 1) % hm.size(3) + 1)
-    preds[..., 1].add_(-1).div_(hm.size(2)).floor_().add_(1)
-
-    for i in range(preds.size(0)):
-        for j in range(preds.size(1)):
-            hm_ = hm[i, j, :]
-            pX, pY = int(preds[i, j, 0]) - 1, int(preds[i, j, 1]) - 1
-            if pX > 0 and pX < 63 and pY > 0 and pY < 63:
-                diff = torch.FloatTensor(
-                    [hm_[pY, pX + 1] - hm_[pY, pX - 1],
-                     hm_[pY + 1, pX] - hm_[pY - 1, pX]])
-                preds[i, j].add_(diff.sign_().mul_(.25))
-
-    preds.add_(-.5)
-
-    preds_orig = torch.zeros(preds.size())
+    B, C, H, W = hm.shape
+    hm = hm.reshape(B, C, H * W)
+    _, idx = torch.max(hm, 2)
+    pX, pY = idx % W, idx // W
+
+    # move a quarter of a pixel towards the highest neighbour, away from the borders
+    inside = (pX > 0) & (pX < W - 1) & (pY > 0) & (pY < H - 1)
+    def at(dy, dx):
+        return hm.gather(2, ((pY + dy).clamp(0, H - 1) * W + (pX + dx).clamp(0, W - 1)).unsqueeze(2)).squeeze(2)
+    diff = torch.stack([at(0, 1) - at(0, -1), at(1, 0) - at(-1, 0)], 2)
+    preds = torch.stack([pX, pY], 2).float() + 1
+    preds += diff.sign() * .25 * inside.unsqueeze(2)
+    preds -= .5
+
+    preds_orig = torch.zeros(preds.size(), device=preds.device)
     if centers is not None and scales is not None:
-        for i in range(hm.size(0)):
-            for j in range(hm.size(1)):
-                preds_orig[i, j] = transform(
-                    preds[i, j], centers[i], scales[i], hm.size(2), True)
+        # inverse of the crop transform of every face (see ``transform``)
+        centers = torch.as_tensor(centers, dtype=torch.float64, device=preds.device).view(B, 1, 2)
+        h = 200.0 * torch.as_tensor(scales, dtype=torch.float64, device=preds.device).view(B, 1, 1)
+        preds_orig = (preds.double() * h / H + centers - h / 2).int().float()
 
     return preds, preds_orig
 
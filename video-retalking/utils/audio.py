@@ -1,20 +1,51 @@
-import librosa
-import librosa.filters
+import struct
+import subprocess
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 # import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
 from .hparams import hparams as hp
 
+# librosa is slow to import, it is only imported by the functions using it
+
 def load_wav(path, sr):
+    import librosa
     return librosa.core.load(path, sr=sr)[0]
 
+def load_audio(path, sr):
+    """The audio track of any file ffmpeg reads, as mono float32 samples at ``sr`` Hz.
+
+    ffmpeg decodes and resamples it into a pipe, so there is no temporary wav file to write and decode
+    again, and no librosa resampling. The channels are averaged like ``librosa.to_mono`` does (ffmpeg's
+    own downmix scales a stereo track by sqrt(2)), their number is read from the wav header of the pipe.
+    """
+    command = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', path, '-map', '0:a:0',
+               '-f', 'wav', '-acodec', 'pcm_f32le', '-ar', str(sr), '-']
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError('ffmpeg failed to read the audio of {}: {}'.format(
+            path, process.stderr.decode('utf-8', 'replace').strip()))
+    data = process.stdout
+    channels, offset = None, 12
+    # the sizes in the header of a piped wav are unknown, the samples are the rest of the stream
+    while data[offset:offset + 4] != b'data':
+        chunk_size = struct.unpack('<I', data[offset + 4:offset + 8])[0]
+        if data[offset:offset + 4] == b'fmt ':
+            channels = struct.unpack('<H', data[offset + 10:offset + 12])[0]
+        offset += 8 + chunk_size + chunk_size % 2
+    samples = data[offset + 8:]
+    wav = np.frombuffer(samples[:len(samples) - len(samples) % (4 * channels)], dtype='<f4').reshape(-1, channels)
+    return wav[:, 0].copy() if channels == 1 else wav.mean(1, dtype=np.float32)
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     #proposed by @dsmiller
     wavfile.write(path, sr, wav.astype(np.int16))
 
 def save_wavenet_wav(wav, path, sr):
+    import librosa
     librosa.output.write_wav(path, wav, sr=sr)
 
 def preemphasis(wav, k, preemphasize=True):
@@ -42,7 +73,10 @@ def linearspectrogram(wav):
         return _normalize(S)
     return S
 
-def melspectrogram(wav):
+def melspectrogram(wav, frontend=None):
+    """Mel spectrogram of ``wav``, computed by librosa or by torch (``frontend``, ``hp.mel_frontend`` by default)."""
+    if (frontend or hp.mel_frontend) == 'torch':
+        return _torch_melspectrogram(wav)
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
     S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
     
@@ -50,6 +84,30 @@ def melspectrogram(wav):
         return _normalize(S)
     return S
 
+class MelChunks(object):
+    """The ``mel_step_size`` mel frames of every video frame at ``fps``, as views into ``mel`` instead of copies.
+
+    Chunk ``i`` starts at mel frame ``int(i * 80 / fps)`` (80 mel frames per second), the last one ends with the spectrogram.
+    """
+
+    def __init__(self, mel, fps, mel_step_size=16):
+        if mel.shape[1] < mel_step_size:
+            raise ValueError('The audio is too short, at least {} mel frames are needed'.format(mel_step_size))
+        mel_idx_multiplier = 80. / fps
+        self.windows = sliding_window_view(mel, mel_step_size, axis=1)
+        starts = (np.arange(int(mel.shape[1] / mel_idx_multiplier) + 2) * mel_idx_multiplier).astype(np.int64)
+        self.starts = np.append(starts[starts + mel_step_size <= mel.shape[1]], mel.shape[1] - mel_step_size)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        return self.windows[:, self.starts[idx]]
+
+    def __iter__(self):
+        for start in self.starts:
+            yield self.windows[:, start]
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
@@ -58,6 +116,7 @@ def _stft(y):
     if hp.use_lws:
         return _lws_processor(hp).stft(y).T
     else:
+        import librosa
         return librosa.stft(y=y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size)
 
 ##########################################################
@@ -96,10 +155,63 @@ def _linear_to_mel(spectogram):
     return np.dot(_mel_basis, spectogram)
 
 def _build_mel_basis():
+    import librosa.filters
     assert hp.fmax <= hp.sample_rate // 2
     return librosa.filters.mel(hp.sample_rate, hp.n_fft, n_mels=hp.num_mels,
                                fmin=hp.fmin, fmax=hp.fmax)
 
+def _hz_to_mel(frequencies):
+    # Slaney's mel scale, librosa's default: linear below 1 kHz, logarithmic above
+    frequencies = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+    mels = frequencies / (200.0 / 3)
+    log_t = frequencies >= 1000.0
+    mels[log_t] = 15.0 + np.log(frequencies[log_t] / 1000.0) / (np.log(6.4) / 27.0)
+    return mels
+
+def _mel_to_hz(mels):
+    frequencies = mels * (200.0 / 3)
+    log_t = mels >= 15.0
+    frequencies[log_t] = 1000.0 * np.exp((np.log(6.4) / 27.0) * (mels[log_t] - 15.0))
+    return frequencies
+
+def _numpy_mel_basis():
+    """``librosa.filters.mel`` of the hparams (Slaney mel scale and area normalization) without importing librosa."""
+    assert hp.fmax <= hp.sample_rate // 2
+    fftfreqs = np.linspace(0, hp.sample_rate / 2, 1 + hp.n_fft // 2)
+    mel_f = _mel_to_hz(np.linspace(_hz_to_mel(hp.fmin)[0], _hz_to_mel(hp.fmax)[0], hp.num_mels + 2))
+    fdiff = np.diff(mel_f)
+    ramps = mel_f[:, None] - fftfreqs[None]
+    lower = -ramps[:-2] / fdiff[:-1, None]
+    upper = ramps[2:] / fdiff[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+    weights *= (2.0 / (mel_f[2:] - mel_f[:-2]))[:, None]
+    return weights.astype(np.float32)
+
+_torch_mel_basis = None
+
+def _torch_melspectrogram(wav):
+    """``melspectrogram`` with the pre-emphasis, the STFT and the mel projection in torch, which runs them
+    vectorized over all the cores. In float32, within 1e-3 of the librosa frontend on the normalized mels
+    (see benchmarks/check_mel_frontend.py)."""
+    import torch
+    global _torch_mel_basis
+    if _torch_mel_basis is None:
+        _torch_mel_basis = torch.from_numpy(_numpy_mel_basis())
+
+    y = torch.from_numpy(np.asarray(wav, dtype=np.float32))
+    if hp.preemphasize:
+        y = torch.cat([y[:1], y[1:] - hp.preemphasis * y[:-1]])
+    window = torch.hann_window(hp.win_size or hp.n_fft, periodic=True)
+    with torch.no_grad():
+        D = torch.stft(y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size, window=window,
+                       center=True, pad_mode='constant', return_complex=True).abs()
+        S = torch.matmul(_torch_mel_basis, D).numpy()
+    S = _amp_to_db(S) - hp.ref_level_db
+
+    if hp.signal_normalization:
+        return _normalize(S)
+    return S
+
 def _amp_to_db(x):
     min_level = np.exp(hp.min_level_db / 20 * np.log(10))
     return 20 * np.log10(np.maximum(min_level, x))
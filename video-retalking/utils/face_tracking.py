@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+
+def to_gray(image):
+    image = np.asarray(image)
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+
+def track_points(prev_gray, gray, points, max_error=1.):
+    """``points`` ``(N, 2)`` of ``prev_gray`` moved to ``gray`` by pyramidal Lucas-Kanade optical flow, and
+    which of them are reliable: found in both directions and back within ``max_error`` pixels of where they started."""
+    p0 = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 1, 2)
+    p1, found, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, p0, None, **LK_PARAMS)
+    p0_back, found_back, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, p1, None, **LK_PARAMS)
+    error = np.linalg.norm((p0 - p0_back).reshape(-1, 2), axis=1)
+    reliable = (found.reshape(-1) == 1) & (found_back.reshape(-1) == 1) & (error < max_error)
+    return p1.reshape(-1, 2), reliable
+
+
+def box_features(gray, box, max_corners=64):
+    """Corners worth tracking inside the ``(x1, y1, x2, y2)`` box, ``None`` if the face has too little texture."""
+    x1, y1, x2, y2 = [int(round(v)) for v in box[:4]]
+    mask = np.zeros(gray.shape, dtype=np.uint8)
+    mask[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)] = 255
+    corners = cv2.goodFeaturesToTrack(gray, max_corners, 0.01, 5, mask=mask)
+    return None if corners is None or len(corners) < 8 else corners.reshape(-1, 2)
+
+
+class KeyframeTracker(object):
+    """Follows the landmarks (or the box) of a face from a keyframe through the next frames with optical flow,
+    so the detector and FAN only run on the keyframes.
+
+    ``follow`` returns ``None`` when the next frame has to be a keyframe: ``interval`` frames after the last
+    one, when the face moved more than ``motion_threshold`` pixels since the previous frame, or when less
+    than ``min_tracked`` of the points could be tracked reliably (the confidence check).
+
+    Args:
+        interval (int): a keyframe every ``interval`` frames at least.
+        motion_threshold (float): median motion of the points, in pixels per frame, forcing a keyframe.
+        min_tracked (float): fraction of the points that have to be tracked reliably.
+        max_error (float): forward-backward error in pixels above which a point is not reliable.
+    """
+
+    def __init__(self, interval=10, motion_threshold=8., min_tracked=0.7, max_error=1.):
+        self.interval = interval
+        self.motion_threshold = motion_threshold
+        self.min_tracked = min_tracked
+        self.max_error = max_error
+        self.keyframes, self.tracked = 0, 0
+        self.reset()
+
+    def reset(self):
+        """Forget the face, the next frame is a keyframe."""
+        self.gray, self.points, self.box, self.age = None, None, None, 0
+
+    def start(self, image, points, box=None):
+        """``image`` is a keyframe where the face has these ``points``; its ``(x1, y1, x2, y2)`` ``box`` is moved along."""
+        self.keyframes += 1
+        if points is None:
+            self.reset()
+            return
+        self.gray = to_gray(image)
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        self.box = None if box is None else np.asarray(box[:4], dtype=np.float32)
+        self.age = 0
+
+    def follow(self, image):
+        """The points moved to ``image``, or ``None`` if it has to be a keyframe."""
+        if self.points is None or self.age + 1 >= self.interval:
+            return None
+        gray = to_gray(image)
+        points, reliable = track_points(self.gray, gray, self.points, self.max_error)
+        if reliable.mean() < self.min_tracked:
+            return None
+        shift = np.median(points[reliable] - self.points[reliable], 0)
+        if np.linalg.norm(shift) > self.motion_threshold:
+            return None
+        # the points lost by the flow move with the others
+        points[~reliable] = self.points[~reliable] + shift
+        self.gray, self.points, self.age = gray, points, self.age + 1
+        if self.box is not None:
+            self.box = self.box + np.tile(shift, 2)
+        self.tracked += 1
+        return points
+
+    def stats(self):
+        return {'keyframes': self.keyframes, 'tracked': self.tracked}
+
+
+def tracker_from_options(args):
+    """A ``KeyframeTracker`` if ``args.track_faces`` is set, else ``None``."""
+    if not getattr(args, 'track_faces', False):
+        return None
+    return KeyframeTracker(args.keyframe_interval, args.track_motion_threshold)
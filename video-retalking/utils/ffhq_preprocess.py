@@ -115,18 +115,19 @@ class Croper:
         # Save aligned image.
         return crop, [lx, ly, rx, ry]
     
-    def crop(self, img_np_list, xsize=512):    # first frame for all video
-        idx = 0
-        while idx < len(img_np_list)//2 :   # TODO 
-            img_np = img_np_list[idx]
+    def find_crop(self, frames, xsize=512):
+        """``(crop, quad)`` aligning the first face found in the RGB ``frames`` (any iterable), ``None`` without a face."""
+        for img_np in frames:
             lm = self.get_landmark(img_np)
-            if lm is not None:  
-                break   # can detect face
-            idx += 1
-        if lm is None:
+            if lm is not None:  # can detect face
+                return self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+        return None
+
+    def crop(self, img_np_list, xsize=512):    # first frame for all video
+        found = self.find_crop(img_np_list[:max(len(img_np_list)//2, 1)], xsize=xsize)
+        if found is None:
             return None
-        
-        crop, quad = self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+        crop, quad = found
         clx, cly, crx, cry = crop
         lx, ly, rx, ry = quad
         lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
@@ -0,0 +1,91 @@
+import cv2
+
+
+class FrameReader(object):
+    """Decodes the frames of a video (or a single image) on demand instead of keeping them in memory.
+
+    Every pass over the video opens its own capture, so the peak memory only depends on how many
+    frames a stage holds at a time (``chunks``), not on the length of the video.
+
+    Args:
+        path (str): video or image file.
+        crop (list): ``[y1, y2, x1, x2]`` region kept from every frame, -1 for the full size.
+        fps (float): frame rate reported for an image.
+    """
+    image_extensions = ['jpg', 'png', 'jpeg']
+
+    def __init__(self, path, crop=(0, -1, 0, -1), fps=25.):
+        self.path = path
+        self.crop = crop
+        self.static = path.split('.')[-1] in self.image_extensions
+        if self.static:
+            self.fps, self.frame_count = fps, 1
+            return
+        video_stream = cv2.VideoCapture(path)
+        if not video_stream.isOpened():
+            raise ValueError('Could not open the video {}'.format(path))
+        self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+        # the container's estimate, only exact once a pass went through the whole video
+        self.frame_count = int(video_stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        video_stream.release()
+
+    def _crop(self, frame):
+        y1, y2, x1, x2 = self.crop
+        if x2 == -1: x2 = frame.shape[1]
+        if y2 == -1: y2 = frame.shape[0]
+        return frame[y1:y2, x1:x2]
+
+    def iter(self, start=0, stop=None):
+        """Frames ``[start, stop)``, decoded one at a time."""
+        if self.static:
+            if start == 0 and stop != 0:
+                yield self._crop(cv2.imread(self.path))
+            return
+        video_stream = cv2.VideoCapture(self.path)
+        try:
+            if start > 0:
+                video_stream.set(cv2.CAP_PROP_POS_FRAMES, start)
+            idx = start
+            while stop is None or idx < stop:
+                still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                yield self._crop(frame)
+                idx += 1
+        finally:
+            video_stream.release()
+
+    def __iter__(self):
+        return self.iter()
+
+    def chunks(self, chunk_size, start=0, stop=None):
+        """Lists of at most ``chunk_size`` consecutive frames of ``[start, stop)``."""
+        chunk = []
+        for frame in self.iter(start, stop):
+            chunk.append(frame)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def cycle(self, length, num_frames):
+        """``length`` frames going through the first ``num_frames`` frames again and again."""
+        if self.static:
+            frame = self[0]
+            for _ in range(length):
+                yield frame
+            return
+        done = 0
+        while done < length:
+            passed = done
+            for frame in self.iter(0, min(num_frames, length - done)):
+                yield frame
+                done += 1
+            if done == passed:
+                raise ValueError('No frame could be read from {}'.format(self.path))
+
+    def __getitem__(self, idx):
+        for frame in self.iter(idx, idx + 1):
+            return frame
+        raise IndexError('Frame {} is past the end of {}'.format(idx, self.path))
@@ -59,6 +59,7 @@ hparams = HParams(
 	# Set this to 55 if your speaker is male! if female, 95 should help taking off noise. (To 
 	# test depending on dataset. Pitch info: male~[65, 260], female~[100, 525])
 	fmax=7600,  # To be increased/reduced depending on data.
+	mel_frontend='librosa',  # 'librosa', or 'torch' for torch.stft running on all the cores (see utils/audio.py)
 
 	###################### Our training parameters #################################
 	img_size=96,
@@ -128,6 +129,7 @@ hparamsdebug = HParams(
 	# Set this to 55 if your speaker is male! if female, 95 should help taking off noise. (To 
 	# test depending on dataset. Pitch info: male~[65, 260], female~[100, 525])
 	fmax=7600,  # To be increased/reduced depending on data.
+	mel_frontend='librosa',  # 'librosa', or 'torch' for torch.stft running on all the cores (see utils/audio.py)
 )
 
 
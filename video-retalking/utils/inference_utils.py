@@ -1,5 +1,5 @@
 import numpy as np
-import cv2, argparse, torch
+import cv2, os, argparse, torch
 import torchvision.transforms.functional as TF
 
 from models import load_network, load_DNet
@@ -8,11 +8,12 @@ from PIL import Image
 from scipy.spatial import ConvexHull
 from third_part import face_detection
 from third_part.face3d.models import networks
+from utils.face_tracking import box_features, tracker_from_options
 
 import warnings
 warnings.filterwarnings("ignore")
 
-def options():
+def options(argv=None):
     parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
 
     parser.add_argument('--DNet_path', type=str, default='checkpoints/DNet.pt')
@@ -21,6 +22,8 @@ def options():
     parser.add_argument('--face3d_net_path', type=str, default='checkpoints/face3d_pretrain_epoch_20.pth')                      
     parser.add_argument('--face', type=str, help='Filepath of video/image that contains faces to use', required=True)
     parser.add_argument('--audio', type=str, help='Filepath of video/audio file to use as raw audio source', required=True)
+    parser.add_argument('--mel_frontend', type=str, choices=['librosa', 'torch'], default=None,
+                        help='Mel spectrogram implementation, hparams.mel_frontend by default')
     parser.add_argument('--exp_img', type=str, help='Expression template. neutral, smile or image path', default='neutral')
     parser.add_argument('--outfile', type=str, help='Video path to save result')
 
@@ -28,6 +31,9 @@ def options():
     parser.add_argument('--pads', nargs='+', type=int, default=[0, 20, 0, 0], help='Padding (top, bottom, left, right). Please adjust to include chin at least')
     parser.add_argument('--face_det_batch_size', type=int, help='Batch size for face detection', default=4)
     parser.add_argument('--LNet_batch_size', type=int, help='Batch size for LNet', default=16)
+    parser.add_argument('--face3d_batch_size', type=int, help='Batch size for the 3DMM coefficients network', default=16)
+    parser.add_argument('--DNet_batch_size', type=int, help='Batch size for DNet', default=8)
+    parser.add_argument('--GPEN_batch_size', type=int, help='Batch size for GPEN and the face parser in Step 5', default=8)
     parser.add_argument('--img_size', type=int, default=384)
     parser.add_argument('--crop', nargs='+', type=int, default=[0, -1, 0, -1], 
                         help='Crop video to a smaller region (top, bottom, left, right). Applied after resize_factor and rotate arg. ' 
@@ -43,9 +49,30 @@ def options():
     parser.add_argument('--one_shot', action='store_true')
     parser.add_argument('--without_rl1', default=False, action='store_true', help='Do not use the relative l1')
     parser.add_argument('--tmp_dir', type=str, default='temp', help='Folder to save tmp results')
+    parser.add_argument('--work_dir', type=str, default='temp', help='Folder for the intermediate files of this run (contains tmp_dir)')
+    parser.add_argument('--cache_dir', type=str, default='temp/preprocess_cache', help='Folder of the preprocessing results shared by the runs on the same video, empty to disable')
+    parser.add_argument('--cache_max_gb', type=float, default=20, help='Size of the preprocessing cache above which entries are evicted')
+    parser.add_argument('--cache_policy', type=str, default='lru', choices=['lru', 'lfu'], help='Evict the least recently (lru) or least frequently (lfu) used entries first')
+    parser.add_argument('--frame_chunk_size', type=int, default=64, help='Number of full size frames decoded at a time')
+    parser.add_argument('--encoder_preset', type=str, default='veryfast', help='x264 preset of the output video')
+    parser.add_argument('--encoder_crf', type=int, default=18, help='x264 constant rate factor of the output video, lower is better quality')
+    parser.add_argument('--encoder_threads', type=int, default=0, help='Threads of the output video encoder, 0 for automatic')
+    parser.add_argument('--step6_workers', type=int, default=0, help='Threads compositing the frames of Step 6, 0 for one per core')
+    parser.add_argument('--prefetch_batches', type=int, default=2, help='LNet batches prepared ahead of LNet in Step 6')
+    parser.add_argument('--timing_report', type=str, default='', help='JSON file receiving the wall time, fps and memory of every stage')
+    parser.add_argument('--track_faces', default=False, action='store_true', help='Only detect the face on keyframes and follow it with optical flow in between')
+    parser.add_argument('--keyframe_interval', type=int, default=10, help='Frames between two keyframes of --track_faces')
+    parser.add_argument('--track_motion_threshold', type=float, default=8., help='Motion of the face in pixels per frame forcing a keyframe with --track_faces')
     parser.add_argument('--re_preprocess', action='store_true')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    return args
+
+def default_options(**kwargs):
+    """Return the CLI defaults as a namespace, with ``kwargs`` applied on top."""
+    args = options(['--face', kwargs.pop('face', ''), '--audio', kwargs.pop('audio', '')])
+    for key, value in kwargs.items():
+        setattr(args, key, value)
     return args
 
 exp_aus_dict = {        # AU01_r, AU02_r, AU04_r, AU05_r, AU06_r, AU07_r, AU09_r, AU10_r, AU12_r, AU14_r, AU15_r, AU17_r, AU20_r, AU23_r, AU25_r, AU26_r, AU45_r.
@@ -96,6 +123,33 @@ def find_crop_norm_ratio(source_coeff, target_coeffs):
     crop_norm_ratio = source_coeff[:,-3] / target_coeffs[index:index+1, -3]
     return crop_norm_ratio
 
+def self_crop_norm_ratios(coeffs):
+    """``find_crop_norm_ratio`` of every frame of ``coeffs`` against all of them, without the N x N distances:
+    the closest frame to a frame is the first one with exactly its expression and pose, usually itself."""
+    keys = coeffs[:, np.r_[80:144, 224:227]] + 0.  # -0. == 0.
+    nan_rows = np.flatnonzero(np.isnan(keys).any(1))
+    if len(nan_rows):  # argmin picks the first NaN distance: to the first NaN row, or to row 0 from a NaN row
+        index = np.full(len(coeffs), nan_rows[0])
+        index[nan_rows] = 0
+    else:
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        index = first[inverse.reshape(-1)]
+    return coeffs[:, -3] / coeffs[index, -3]
+
+def transform_semantic_batch(semantic, frame_indices, crop_norm_ratios=None):
+    """``transform_semantic`` of several frames at once, a ``(len(frame_indices), 73, 26)`` tensor."""
+    frame_indices = np.asarray(frame_indices)
+    index = np.clip(frame_indices[:, None] + np.arange(-13, 13), 0, semantic.shape[0] - 1)
+
+    coeff_3dmm = semantic[index]
+    coeff_3dmm = np.concatenate([coeff_3dmm[..., 80:144], coeff_3dmm[..., 224:227], coeff_3dmm[..., 254:257],
+                                 coeff_3dmm[..., 259:262]], 2)
+    if crop_norm_ratios is not None:
+        # a ratio of 0 leaves the crop as it is, like in transform_semantic
+        ratios = np.asarray(crop_norm_ratios)
+        coeff_3dmm[..., -3] *= np.where(ratios == 0, 1, ratios)[:, None]
+    return torch.Tensor(coeff_3dmm).permute(0, 2, 1)
+
 def get_smoothened_boxes(boxes, T):
     for i in range(len(boxes)):
         if i + T > len(boxes):
@@ -105,11 +159,17 @@ def get_smoothened_boxes(boxes, T):
         boxes[i] = np.mean(window, axis=0)
     return boxes
 
-def face_detect(images, args, jaw_correction=False, detector=None):
+def detect_face_rects(images, args, detector=None, tracker=None):
+    """Raw S3FD boxes ``(x1, y1, x2, y2)`` of ``images``, ``None`` where no face is found.
+
+    With a ``KeyframeTracker`` the detector only runs on its keyframes, see ``track_face_rects``.
+    """
     if detector == None:
         device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
         detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
                                                 flip_input=False, device=device)
+    if tracker is not None:
+        return track_face_rects(images, detector, tracker, args.face_det_batch_size)
 
     batch_size = args.face_det_batch_size    
     while 1:
@@ -124,25 +184,75 @@ def face_detect(images, args, jaw_correction=False, detector=None):
             print('Recovering from OOM error; New batch size: {}'.format(batch_size))
             continue
         break
-
+    return predictions
+
+def track_face_rects(images, detector, tracker, batch_size=1):
+    """``detect_face_rects`` of consecutive frames, the box found on a keyframe following the corners
+    of the face through the next frames. ``tracker`` keeps its state from one call to the next.
+
+    The keyframes are detected ``batch_size`` at a time: a keyframe the tracker asks for is detected with
+    the next ones of its schedule (every ``tracker.interval`` frames), and a frame already detected is
+    always a keyframe, even when an earlier forced keyframe moved the schedule.
+    """
+    rects, detected = [], {}
+    for idx, image in enumerate(tqdm(images, desc='FaceDet (tracking):')):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if idx not in detected:
+            if tracker.follow(gray) is not None:
+                rects.append(tuple(int(round(v)) for v in tracker.box))
+                continue
+            ahead = range(idx, min(len(images), idx + batch_size * tracker.interval), tracker.interval)
+            detected.update(zip(ahead, detector.get_detections_for_batch(np.array([images[i] for i in ahead]))))
+        rect = detected.pop(idx)
+        tracker.start(gray, None if rect is None else box_features(gray, rect), rect)
+        rects.append(rect)
+    return rects
+
+def face_boxes(rects, images, args, jaw_correction=False):
+    """Padded and smoothed ``(y1, y2, x1, x2)`` face boxes from the ``detect_face_rects`` of ``images``.
+
+    ``images`` is only indexed to get the frame size and to save a frame without a face, so it can be a ``FrameReader``.
+    """
+    frame_h, frame_w = images[0].shape[:2]
     results = []
     pady1, pady2, padx1, padx2 = args.pads if jaw_correction else (0,20,0,0)
-    for rect, image in zip(predictions, images):
-        if rect is None:
-            cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
+    for idx, rect in enumerate(rects):
+        if rect is None or rect[0] < 0:
+            cv2.imwrite(os.path.join(args.work_dir, 'faulty_frame.jpg'), images[idx]) # check this frame where the face was not detected.
             raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
 
         y1 = max(0, rect[1] - pady1)
-        y2 = min(image.shape[0], rect[3] + pady2)
+        y2 = min(frame_h, rect[3] + pady2)
         x1 = max(0, rect[0] - padx1)
-        x2 = min(image.shape[1], rect[2] + padx2)
+        x2 = min(frame_w, rect[2] + padx2)
         results.append([x1, y1, x2, y2])
 
     boxes = np.array(results)
     if not args.nosmooth: boxes = get_smoothened_boxes(boxes, T=5)
-    results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
+    return [(y1, y2, x1, x2) for (x1, y1, x2, y2) in boxes]
+
+def landmarks_to_5pts(lm):
+    """The 5 points of RetinaFace (eyes, nose tip, mouth corners) from 68 FAN landmarks ``(..., 68, 2)``."""
+    lm = np.asarray(lm, dtype=np.float32)
+    return np.stack([lm[..., 36:42, :].mean(-2), lm[..., 42:48, :].mean(-2), lm[..., 30, :], lm[..., 48, :], lm[..., 54, :]], -2)
+
+def crop_to_frame(points, cox, size=256):
+    """Map points ``(..., 2)`` of the ``size`` x ``size`` face crops back to the frames the ``cox`` region was cut from."""
+    oy1, oy2, ox1, ox2 = cox
+    return np.asarray(points) * [(ox2 - ox1) / size, (oy2 - oy1) / size] + [ox1, oy1]
+
+def frame_to_crop(rects, cox, size=256):
+    """Map ``(x1, y1, x2, y2)`` face boxes of the frames into the face crops, keeping the -1 rows of missing faces."""
+    oy1, oy2, ox1, ox2 = cox
+    rects = np.asarray(rects, dtype=np.float32)
+    scale = np.array([size / (ox2 - ox1), size / (oy2 - oy1)] * 2, dtype=np.float32)
+    return np.where(rects[:, :1] < 0, -1, (rects - [ox1, oy1, ox1, oy1]) * scale)
+
+def face_detect(images, args, jaw_correction=False, detector=None):
+    """Padded and smoothed face crops of ``images``, the face followed between keyframes with ``args.track_faces``."""
+    boxes = face_boxes(detect_face_rects(images, args, detector, tracker_from_options(args)), images, args, jaw_correction)
+    results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (y1, y2, x1, x2) in zip(images, boxes)]
 
-    del detector
     torch.cuda.empty_cache()
     return results 
 
@@ -200,8 +310,9 @@ def Laplacian_Pyramid_Blending_with_mask(A, B, m, num_levels = 6):
     for i in range(num_levels-1,0,-1):
         # Laplacian: subtract upscaled version of lower level from current level
         # to get the high frequencies
-        LA = np.subtract(gpA[i-1], cv2.pyrUp(gpA[i]))
-        LB = np.subtract(gpB[i-1], cv2.pyrUp(gpB[i]))
+        # dstsize: the sizes need not be multiples of 2 ** num_levels
+        LA = np.subtract(gpA[i-1], cv2.pyrUp(gpA[i], dstsize=gpA[i-1].shape[1::-1]))
+        LB = np.subtract(gpB[i-1], cv2.pyrUp(gpB[i], dstsize=gpB[i-1].shape[1::-1]))
         lpA.append(LA)
         lpB.append(LB)
         gpMr.append(gpM[i-1]) # also reverse the masks
@@ -216,10 +327,145 @@ def Laplacian_Pyramid_Blending_with_mask(A, B, m, num_levels = 6):
     # now reconstruct
     ls_ = LS[0]
     for i in range(1,num_levels):
-        ls_ = cv2.pyrUp(ls_)
+        ls_ = cv2.pyrUp(ls_, dstsize=LS[i].shape[1::-1])
         ls_ = cv2.add(ls_, LS[i])
     return ls_
 
+def _reflect101_index(n, before, after, device):
+    """Indices of ``n`` samples padded with OpenCV's default border (``BORDER_REFLECT_101``)."""
+    idx = torch.arange(-before, n + after, device=device)
+    if n == 1:
+        return torch.zeros_like(idx)
+    period = 2 * (n - 1)
+    idx = idx.abs() % period
+    return torch.where(idx >= n, period - idx, idx)
+
+# the filters are sums of shifted slices rather than convolutions: exact for the uint8 levels (no TF32)
+def _pyr_down_last(x):
+    # [1, 4, 6, 4, 1] along the last dimension, every other sample
+    n = x.shape[-1]
+    m = (n + 1) // 2
+    p = x.index_select(-1, _reflect101_index(n, 2, 2, x.device))
+    return p[..., 0:2*m:2] + 4 * p[..., 1:2*m+1:2] + 6 * p[..., 2:2*m+2:2] + 4 * p[..., 3:2*m+3:2] + p[..., 4:2*m+4:2]
+
+def _pyr_up_last(x):
+    # the [1, 4, 6, 4, 1] filter of the zero upsampled last dimension, as cv2.pyrUp pads it
+    n = x.shape[-1]
+    idx = torch.cat([_reflect101_index(n, 1, 0, x.device)[:1], torch.arange(n, device=x.device),
+                     torch.full((1,), n - 1, dtype=torch.long, device=x.device)])
+    p = x.index_select(-1, idx)
+    even = p[..., :-2] + 6 * p[..., 1:-1] + p[..., 2:]
+    odd = 4 * (p[..., 1:-1] + p[..., 2:])
+    return torch.stack([even, odd], -1).flatten(-2)
+
+def pyr_down(x, quantize=False):
+    """``cv2.pyrDown`` of a ``(N, C, H, W)`` tensor; ``quantize`` rounds like it does for uint8 images."""
+    x = _pyr_down_last(_pyr_down_last(x).transpose(-1, -2)).transpose(-1, -2)
+    if quantize:
+        return torch.floor((x + 128) / 256)
+    return x / 256
+
+def pyr_up(x, size=None):
+    """``cv2.pyrUp`` of a ``(N, C, H, W)`` tensor, cropped to ``size`` ``(H', W')`` if given."""
+    x = _pyr_up_last(_pyr_up_last(x).transpose(-1, -2)).transpose(-1, -2) / 64
+    if size is not None:
+        x = x[..., :size[0], :size[1]]
+    return x
+
+def pyramid_levels(size, num_levels, min_size=1):
+    """``num_levels``, capped so that the smallest level of an image of ``size`` ``(H, W)`` keeps ``min_size`` pixels."""
+    levels = 1
+    while levels < num_levels and (min(size) + 2 ** levels - 1) // 2 ** levels >= min_size:
+        levels += 1
+    return levels
+
+def feather_region(box, height, width, margin, size=None):
+    """The ``(y1, y2, x1, x2)`` region of a ``height`` x ``width`` frame blended around a ``(y1, y2, x1, x2)`` ``box``:
+    the box and a ``margin`` of pixels on every side for the blending to fade out, clipped to the frame.
+
+    With ``size`` ``(h, w)``, the region has this size instead, centered on the box and moved inside the frame.
+    """
+    y1, y2, x1, x2 = [int(v) for v in box[:4]]
+    if size is None:
+        return max(y1 - margin, 0), min(y2 + margin, height), max(x1 - margin, 0), min(x2 + margin, width)
+    h, w = min(size[0], height), min(size[1], width)
+    top = min(max((y1 + y2 - h) // 2, 0), height - h)
+    left = min(max((x1 + x2 - w) // 2, 0), width - w)
+    return top, top + h, left, left + w
+
+def composite_face(img, ori_img, bbox, face_mask, num_levels=6, min_size=4):
+    """The face of ``img`` pasted into ``ori_img`` like ``FaceEnhancement.process(img, ori_img, bbox, face_enhance=False,
+    possion_blending=True)`` does, from a face mask already parsed instead of aligning and parsing the face again.
+
+    Only a region around ``bbox`` is blended, at native resolution, the rest of ``ori_img`` is passed through.
+
+    Args:
+        img, ori_img (np.ndarray): frames of the same size.
+        bbox (tuple): ``(y1, y2, x1, x2)`` box of the face in the frames.
+        face_mask (np.ndarray): uint8 mask of the face in ``bbox``, 255 on the face, of any size.
+    """
+    height, width = ori_img.shape[:2]
+    y1, y2, x1, x2 = bbox
+    ry1, ry2, rx1, rx2 = feather_region(bbox, height, width, max(y2 - y1, x2 - x1) // 4)
+    mask = np.zeros((ry2 - ry1, rx2 - rx1), dtype=np.float32)
+    mask[y1 - ry1:y2 - ry1, x1 - rx1:x2 - rx1] = cv2.resize(face_mask, (x2 - x1, y2 - y1)) / 255.
+    mask = cv2.GaussianBlur(mask, (0, 0), sigmaX=1, sigmaY=1, borderType=cv2.BORDER_DEFAULT)
+    # the face box without its last 5 rows, as the bbox of FaceEnhancement
+    box = np.zeros_like(mask)
+    box[max(y1 - ry1, 0):max(y2 - 5 - ry1, 0), max(x1 - rx1, 0):max(x2 - rx1, 0)] = 1
+    blended = Laplacian_Pyramid_Blending_with_mask(img[ry1:ry2, rx1:rx2], ori_img[ry1:ry2, rx1:rx2], mask * box,
+                                                   pyramid_levels((ry2 - ry1, rx2 - rx1), num_levels, min_size))
+    out = ori_img.copy()
+    out[ry1:ry2, rx1:rx2] = np.uint8(np.clip(blended, 0, 255))
+    return out
+
+def laplacian_pyramid_blending_batch(A, B, m, num_levels=6, min_size=1, device='cpu'):
+    """``Laplacian_Pyramid_Blending_with_mask`` of a batch of images.
+
+    On a GPU the whole batch goes through the pyramids in one vectorized pass of torch; on the CPU the
+    images are blended one by one by OpenCV, whose pyramids are faster there
+    (see benchmarks/bench_pyramid_blending.py).
+
+    Args:
+        A, B (np.ndarray): ``(N, H, W, C)`` images of the same dtype; uint8 levels are rounded like
+            ``cv2.pyrDown`` does.
+        m (np.ndarray): ``(N, H, W)`` weights of ``A``.
+        min_size (int): levels smaller than ``min_size`` pixels are not built, they barely change the result.
+        device (str): where the pyramids are computed.
+
+    Returns:
+        np.ndarray: ``(N, H, W, C)`` float32 blended images.
+    """
+    num_levels = pyramid_levels(np.shape(A)[1:3], num_levels, min_size)
+    if torch.device(device).type == 'cpu':
+        return np.stack([Laplacian_Pyramid_Blending_with_mask(a, b, mask, num_levels) for a, b, mask in zip(A, B, m)])
+    return laplacian_pyramid_blending_tensor(A, B, m, num_levels, device)
+
+def laplacian_pyramid_blending_tensor(A, B, m, num_levels=6, device='cuda'):
+    """The torch implementation of ``laplacian_pyramid_blending_batch``, on any device."""
+    A, B, m = np.asarray(A), np.asarray(B), np.asarray(m)
+    if A.dtype != B.dtype:
+        raise ValueError('A and B should have the same dtype, not {} and {}'.format(A.dtype, B.dtype))
+    C = A.shape[-1]
+    with torch.no_grad():
+        # A and B go through the pyramids together, as channels of the same images
+        G = torch.from_numpy(np.concatenate([A, B], -1)).to(device).permute(0, 3, 1, 2).float()
+        GM = torch.from_numpy(m).to(device)[:, None].float()
+        gp, gpM = [G], [GM]
+        for i in range(num_levels - 1):
+            gp.append(pyr_down(gp[-1], A.dtype == np.uint8))
+            gpM.append(pyr_down(gpM[-1], m.dtype == np.uint8))
+
+        # blend the Laplacian levels, from the smallest one (the last Gaussian level) up
+        def blend(level, gm):
+            return level[:, :C] * gm + level[:, C:] * (1.0 - gm)
+
+        ls_ = blend(gp[-1], gpM[-1])
+        for i in range(num_levels - 2, -1, -1):
+            size = gp[i].shape[-2:]
+            ls_ = pyr_up(ls_, size) + blend(gp[i] - pyr_up(gp[i + 1], size), gpM[i])
+        return ls_.permute(0, 2, 3, 1).cpu().numpy()
+
 def load_model(args, device):
     D_Net = load_DNet(args).to(device)
     model = load_network(args).to(device)
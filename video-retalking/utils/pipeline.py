@@ -0,0 +1,118 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def prefetch(iterable, depth=2):
+    """Yield the items of ``iterable``, produced ahead by a background thread into a queue of ``depth`` items.
+
+    An exception of ``iterable`` is raised where its item would have been yielded.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # gives up when the consumer is gone, instead of blocking on the full queue forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failure(e))
+
+    thread = threading.Thread(target=produce, name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+class OrderedPool(object):
+    """Runs functions on a pool of worker threads and hands their results to ``consume``, in the order they
+    were submitted, on a thread of its own (e.g. the frames of Step 6 to the video writer).
+
+    Args:
+        consume (callable): called with every result, in submission order.
+        workers (int): threads running the submitted functions.
+        max_pending (int): results submitted but not consumed yet; ``submit`` blocks beyond it, which bounds
+            the memory when the consumer or the workers are slower than the producer.
+    """
+
+    def __init__(self, consume, workers, max_pending):
+        self.consume = consume
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ordered-pool')
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.consumer = threading.Thread(target=self._consume_loop, name='ordered-pool-consumer', daemon=True)
+        self.consumer.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` on a worker; raises the first error of a worker or of ``consume``."""
+        if self.error is not None:
+            raise self.error
+        self.pending.put(self.pool.submit(fn, *args, **kwargs))
+
+    def _consume_loop(self):
+        while True:
+            future = self.pending.get()
+            if future is _DONE:
+                return
+            if self.error is not None:
+                continue  # keep draining, so that submit does not block
+            try:
+                self.consume(future.result())
+            except BaseException as e:
+                self.error = e
+
+    def close(self):
+        """Wait until every result is consumed, and raise the first error of a worker or of ``consume``."""
+        self.pending.put(_DONE)
+        self.consumer.join()
+        self.pool.shutdown()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # the producer failed: skip the work not started yet and stop without consuming the rest
+        self.error = self.error or exc_value
+        while True:
+            try:
+                future = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if future is not _DONE:
+                future.cancel()
+        self.pending.put(_DONE)
+        self.consumer.join()
+        self.pool.shutdown()
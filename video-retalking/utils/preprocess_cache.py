@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: the cache is then only safe within one process
+    fcntl = None
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha256 of the content of ``path``."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock on ``path``, held across threads and processes (e.g. gunicorn workers on a shared volume)."""
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def atomic_save(path, value):
+    """``np.save`` to a temporary file renamed over ``path``, so readers never see a partial entry."""
+    tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, value)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class PreprocessCache(object):
+    """Content-addressed store for the per-video preprocessing results (crop, landmarks,
+    3DMM coeffs, stabilized and enhanced frames, face boxes).
+
+    Entries live in ``cache_dir/<key>/<name>.npy`` where the key is a hash of the face video
+    content and of the options the result depends on, so a presenter video re-uploaded under
+    any name hits the same entry. With ``cache_dir=None`` nothing is stored.
+
+    ``cache_dir/index.json`` records the size, last use and number of uses of every entry. Once the
+    entries exceed ``max_bytes``, the least recently used (``policy='lru'``) or least used
+    (``policy='lfu'``) ones are deleted. The index is only changed under ``cache_dir/.lock`` and an
+    entry is only computed under its own ``.lock``, so several processes can share the directory.
+    """
+    policies = ('lru', 'lfu')
+
+    def __init__(self, cache_dir=None, max_bytes=None, policy='lru'):
+        if policy not in self.policies:
+            raise ValueError('Unknown cache eviction policy {}, expected one of {}'.format(policy, self.policies))
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._counters_lock = threading.Lock()
+        self._file_hashes = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def file_key(self, path):
+        """Hash of a file's content, memoized while its size and mtime do not change."""
+        stat = os.stat(path)
+        memo = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if memo not in self._file_hashes:
+            self._file_hashes[memo] = file_hash(path)
+        return self._file_hashes[memo]
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+    def path(self, key, name):
+        return os.path.join(self.cache_dir, key, name + '.npy')
+
+    def stats(self):
+        """The hit/miss/eviction counters of this process and the current size of the cache."""
+        with self._counters_lock:
+            stats = dict(self.counters)
+        if self.cache_dir:
+            with self._index() as index:
+                stats.update(entries=len(index), bytes=sum(entry['size'] for entry in index.values()))
+        stats.update(max_bytes=self.max_bytes, policy=self.policy)
+        return stats
+
+    def load(self, key, name):
+        if not self.cache_dir:
+            return None
+        try:
+            value = np.load(self.path(key, name))
+        except (OSError, ValueError):  # missing, evicted meanwhile or unreadable
+            self._count('misses')
+            return None
+        self._count('hits')
+        self._touch(key, name)
+        return value
+
+    def save(self, key, name, value):
+        if not self.cache_dir:
+            return
+        os.makedirs(os.path.join(self.cache_dir, key), exist_ok=True)
+        atomic_save(self.path(key, name), np.asarray(value))
+        self._touch(key, name, evict=True)
+
+    def get_or_compute(self, key, name, compute, refresh=False):
+        """Return the cached ``name`` of ``key``, computing and storing it on a miss."""
+        with self._entry_lock(key, name):
+            value = None if refresh else self.load(key, name)
+            if value is not None:
+                print('[Cache] Using saved {}.'.format(name))
+                return value
+            value = np.asarray(compute())
+            self.save(key, name, value)
+            return value
+
+    def get_or_extend(self, key, name, length, compute, refresh=False):
+        """Like ``get_or_compute`` for per-frame results of which only the first ``length`` frames
+        are needed: ``compute(start, stop)`` returns the frames ``[start, stop)`` and a stored prefix
+        shorter than ``length`` is extended instead of recomputed.
+        """
+        with self._entry_lock(key, name):
+            value = None if refresh else self.load(key, name)
+            if value is not None and len(value) >= length:
+                print('[Cache] Using saved {}.'.format(name))
+                return value[:length]
+            start = 0 if value is None else len(value)
+            computed = np.asarray(compute(start, length))
+            value = computed if value is None else np.concatenate([value, computed], 0)
+            self.save(key, name, value)
+            return value
+
+    def _count(self, counter, n=1):
+        with self._counters_lock:
+            self.counters[counter] += n
+
+    @contextmanager
+    def _entry_lock(self, key, name):
+        # a second worker asking for the same entry waits for the first one and then reads its result
+        if not self.cache_dir:
+            yield
+            return
+        os.makedirs(os.path.join(self.cache_dir, key), exist_ok=True)
+        with file_lock(os.path.join(self.cache_dir, key, name + '.lock')):
+            yield
+
+    @contextmanager
+    def _index(self):
+        """The index under the cache lock; changes made to it are written back."""
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        with file_lock(os.path.join(self.cache_dir, '.lock')):
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = self._scan()
+            before = json.dumps(index, sort_keys=True)
+            yield index
+            if json.dumps(index, sort_keys=True) != before:
+                tmp_path = '{}.{}-{}.tmp'.format(index_path, os.getpid(), threading.get_ident())
+                with open(tmp_path, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_path, index_path)
+
+    def _scan(self):
+        """Rebuild a lost index from the entries on disk."""
+        index = {}
+        for key in os.listdir(self.cache_dir):
+            if not os.path.isdir(os.path.join(self.cache_dir, key)):
+                continue
+            for file_name in os.listdir(os.path.join(self.cache_dir, key)):
+                if file_name.endswith('.npy'):
+                    stat = os.stat(os.path.join(self.cache_dir, key, file_name))
+                    index[key + '/' + file_name[:-4]] = {'size': stat.st_size, 'used': stat.st_mtime, 'uses': 0}
+        return index
+
+    def _touch(self, key, name, evict=False):
+        entry_id = key + '/' + name
+        with self._index() as index:
+            entry = index.setdefault(entry_id, {'size': None, 'uses': 0})
+            entry['used'] = time.time()
+            entry['uses'] += 1
+            if evict or entry['size'] is None:
+                entry['size'] = os.path.getsize(self.path(key, name))
+            if evict:
+                self._evict(index, keep=entry_id)
+
+    def _evict(self, index, keep):
+        if self.max_bytes is None:
+            return
+        total = sum(entry['size'] for entry in index.values())
+        if self.policy == 'lru':
+            order = sorted(index, key=lambda entry_id: index[entry_id]['used'])
+        else:
+            order = sorted(index, key=lambda entry_id: (index[entry_id]['uses'], index[entry_id]['used']))
+        for entry_id in order:
+            if total <= self.max_bytes:
+                break
+            if entry_id == keep:
+                continue
+            key, name = entry_id.split('/')
+            try:
+                os.remove(self.path(key, name))
+            except OSError:
+                pass
+            total -= index.pop(entry_id)['size']
+            self._count('evictions')
@@ -0,0 +1,209 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+try:
+    from prometheus_client import Gauge, Histogram
+    STAGE_SECONDS = Histogram('lipsync_stage_seconds', 'Wall time of a pipeline stage in one job', ['stage'],
+                              buckets=(.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+    STAGE_FPS = Gauge('lipsync_stage_fps', 'Frames per second of a pipeline stage in the last job', ['stage'])
+    STAGE_PEAK_RSS = Gauge('lipsync_stage_peak_rss_bytes', 'Peak resident memory of the worker during a stage', ['stage'])
+    STAGE_PEAK_DEVICE = Gauge('lipsync_stage_peak_device_bytes', 'Peak CUDA memory allocated during a stage', ['stage'])
+except ImportError:  # prometheus_client is optional
+    STAGE_SECONDS = None
+
+
+try:
+    import psutil
+except ImportError:  # psutil is optional on Linux
+    psutil = None
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, since it started."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def current_rss():
+    """Resident set size of the process in bytes, now; ``peak_rss`` where neither /proc nor psutil is there."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return peak_rss()
+
+
+# top-level stages measuring the CUDA memory peak, of every profiler: the peak counters are global
+_device_lock = threading.Lock()
+_device_stages = 0
+
+
+class _Peak(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class StageProfiler(object):
+    """Wall time, throughput and memory of the stages of one run of the pipeline.
+
+    A stage entered several times (e.g. ``blending`` once per frame) accumulates its time and frames.
+    Stages may be nested, and may also run on several threads at once (the workers of Step 6): their
+    seconds then add up the time of every thread and can exceed the wall time.
+
+    Only the top-level stages of the thread that created the profiler (the Steps of a run) synchronize
+    CUDA and measure its memory peak, so the other threads never wait for the GPU work queued by LNet.
+    The peak counters of CUDA are global: when the stages of concurrent runs overlap, their peaks cover
+    every run.
+
+    The resident memory of a stage is the largest RSS of the process sampled every ``rss_interval`` seconds
+    while it runs, and when it starts and ends.
+    """
+
+    def __init__(self, rss_interval=0.05):
+        self.stages = OrderedDict()
+        self.started = time.time()
+        self._cuda = torch.cuda.is_available()
+        self._owner = threading.get_ident()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.rss_interval = rss_interval
+        self._rss_peaks = set()
+        self._rss_sampler = None
+
+    @property
+    def _depth(self):
+        # the stages entered and not exited yet, by the current thread
+        return getattr(self._local, 'depth', 0)
+
+    @_depth.setter
+    def _depth(self, depth):
+        self._local.depth = depth
+
+    def _watch_device(self):
+        global _device_stages
+        with _device_lock:
+            if _device_stages == 0:
+                torch.cuda.reset_peak_memory_stats()
+            _device_stages += 1
+
+    def _unwatch_device(self):
+        global _device_stages
+        torch.cuda.synchronize()
+        with _device_lock:
+            _device_stages -= 1
+            return torch.cuda.max_memory_allocated()
+
+    def _watch_rss(self):
+        peak = _Peak(current_rss())
+        with self._lock:
+            self._rss_peaks.add(peak)
+            if self._rss_sampler is None:
+                self._rss_sampler = threading.Thread(target=self._sample_rss, name='profiler-rss', daemon=True)
+                self._rss_sampler.start()
+        return peak
+
+    def _unwatch_rss(self, peak):
+        rss = current_rss()
+        with self._lock:
+            self._rss_peaks.discard(peak)
+        return max(peak.value, rss)
+
+    def _sample_rss(self):
+        # runs while some stage is open, a new one starts with the next stage
+        while True:
+            time.sleep(self.rss_interval)
+            rss = current_rss()
+            with self._lock:
+                if not self._rss_peaks:
+                    self._rss_sampler = None
+                    return
+                for peak in self._rss_peaks:
+                    peak.value = max(peak.value, rss)
+
+    def _record(self, name):
+        return self.stages.setdefault(name, {'seconds': 0., 'calls': 0, 'frames': 0, 'peak_rss': 0, 'peak_device': None})
+
+    @contextmanager
+    def stage(self, name, frames=0):
+        """Time the body as ``name``; the frames it processed can also be added later with ``add_frames``."""
+        device = self._cuda and self._depth == 0 and threading.get_ident() == self._owner
+        if device:
+            self._watch_device()
+        self._depth += 1
+        rss = self._watch_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            device_peak = self._unwatch_device() if device else None
+            seconds = time.perf_counter() - start
+            rss = self._unwatch_rss(rss)
+            self._depth -= 1
+            with self._lock:
+                record = self._record(name)
+                record['seconds'] += seconds
+                record['calls'] += 1
+                record['frames'] += frames
+                record['peak_rss'] = max(record['peak_rss'], rss)
+                if device_peak is not None:
+                    record['peak_device'] = max(record['peak_device'] or 0, device_peak)
+
+    def add_frames(self, name, frames):
+        with self._lock:
+            self._record(name)['frames'] += frames
+
+    def iterate(self, name, iterable, frames=len):
+        """Yield from ``iterable``, timing the production of every item (e.g. the batches of a generator)."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.add_frames(name, frames(item))
+            yield item
+
+    def report(self):
+        stages = OrderedDict()
+        with self._lock:
+            records = [(name, dict(record)) for name, record in self.stages.items()]
+        for name, record in records:
+            stages[name] = {
+                'seconds': round(record['seconds'], 3),
+                'calls': record['calls'],
+                'frames': record['frames'],
+                'fps': round(record['frames'] / record['seconds'], 2) if record['frames'] and record['seconds'] else None,
+                'peak_rss_mb': round(record['peak_rss'] / 2 ** 20, 1),
+                'peak_device_mb': round(record['peak_device'] / 2 ** 20, 1) if record['peak_device'] is not None else None,
+            }
+        return {'total_seconds': round(time.time() - self.started, 3), 'stages': stages}
+
+    def save(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def export_prometheus(self):
+        """Add the stages of this run to the Prometheus metrics of the process, if prometheus_client is installed."""
+        if STAGE_SECONDS is None:
+            return
+        for name, record in self.report()['stages'].items():
+            STAGE_SECONDS.labels(name).observe(record['seconds'])
+            if record['fps'] is not None:
+                STAGE_FPS.labels(name).set(record['fps'])
+            STAGE_PEAK_RSS.labels(name).set(record['peak_rss_mb'] * 2 ** 20)
+            if record['peak_device_mb'] is not None:
+                STAGE_PEAK_DEVICE.labels(name).set(record['peak_device_mb'] * 2 ** 20)
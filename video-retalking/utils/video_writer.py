@@ -0,0 +1,56 @@
+import subprocess
+
+
+class FFmpegWriter(object):
+    """Encodes BGR frames straight to the final H.264 file, muxing ``audio`` in the same ffmpeg pass.
+
+    The frames are piped as raw video to ffmpeg's stdin, so there is no intermediate file to write,
+    decode and encode again.
+
+    Args:
+        path (str): output file.
+        fps (float): frame rate of the frames.
+        frame_size (tuple): ``(height, width)`` of the frames.
+        audio (str): audio track muxed into the output, if any.
+        preset (str): x264 preset, faster presets give bigger files.
+        crf (int): x264 constant rate factor, lower is better quality.
+        threads (int): encoder threads, 0 lets ffmpeg choose.
+    """
+
+    def __init__(self, path, fps, frame_size, audio=None, preset='veryfast', crf=18, threads=0):
+        self.path = path
+        height, width = frame_size
+        command = ['ffmpeg', '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-']
+        if audio is not None:
+            command += ['-i', audio, '-map', '0:v', '-map', '1:a', '-c:a', 'aac']
+        # yuv420p for the players to accept it, which needs even dimensions
+        command += ['-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-threads', str(threads),
+                    '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', '-movflags', '+faststart', path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except BrokenPipeError:
+            self.close()  # ffmpeg exited, report why
+
+    def close(self):
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        error = self.process.stderr.read().decode('utf-8', 'replace')
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg failed to encode {}: {}'.format(self.path, error.strip()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            self.process.wait()
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+class DiskQuotaError(Exception):
+    """Raised when the workspaces already use the whole disk quota."""
+
+
+def dir_size(path):
+    """Total size in bytes of the files under ``path``."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:  # removed while walking
+                pass
+    return total
+
+
+def last_modified(path):
+    """Most recent modification time of ``path`` or of anything under it."""
+    latest = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+            except OSError:
+                pass
+    return latest
+
+
+def publish_file(src, dst):
+    """Copy ``src`` to ``dst`` atomically: readers of ``dst`` see the previous file or the new one, never a partial copy."""
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix='.' + os.path.basename(dst) + '.', dir=os.path.dirname(dst) or '.')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class Workspace:
+    """Private directory of one job: its inputs, the intermediate files of the engine and its result."""
+
+    def __init__(self, root, job_id):
+        self.job_id = job_id
+        self.root = os.path.join(root, job_id)
+        self.temp_dir = os.path.join(self.root, 'temp')
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def size(self):
+        return dir_size(self.root)
+
+    def cleanup(self, keep=()):
+        """Delete everything but the files in ``keep`` (e.g. the result waiting to be downloaded)."""
+        keep = {os.path.abspath(path) for path in keep}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.abspath(path) in keep:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        # the modification time tells purge_expired when the job finished
+        os.utime(self.root)
+        for path in keep:
+            if os.path.exists(path):
+                os.utime(path)
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class WorkspaceManager:
+    """Creates job workspaces under ``root`` and keeps their total size under ``quota_bytes``.
+
+    Finished workspaces only hold the result, which is deleted ``ttl`` seconds after the job finished.
+    Expiry is based on the modification times on disk, so it also collects workspaces left by other
+    workers or by a previous run of the server.
+    """
+
+    def __init__(self, root, quota_bytes, ttl=3600):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.ttl = ttl
+        self.active = set()
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def usage(self):
+        return dir_size(self.root)
+
+    def check_quota(self):
+        self.purge_expired()
+        usage = self.usage()
+        if usage >= self.quota_bytes:
+            raise DiskQuotaError('Workspaces use {:.0f} MB of the {:.0f} MB quota, try again later'.format(
+                usage / 2 ** 20, self.quota_bytes / 2 ** 20))
+        return usage
+
+    def create(self, job_id):
+        with self.lock:
+            self.check_quota()
+            self.active.add(job_id)
+            return Workspace(self.root, job_id)
+
+    def release(self, workspace, keep=()):
+        """Free the scratch files of a finished job; the whole workspace goes if nothing is kept."""
+        with self.lock:
+            self.active.discard(workspace.job_id)
+            if keep:
+                workspace.cleanup(keep)
+            else:
+                workspace.remove()
+
+    def purge_expired(self):
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name in self.active or not os.path.isdir(path):
+                continue
+            try:
+                expired = now - last_modified(path) > self.ttl
+            except OSError:
+                continue
+            if expired:
+                shutil.rmtree(path, ignore_errors=True)